@@ -1,5 +1,9 @@
 import argparse
+import bisect
+import gzip
 import json
+import math
+import os
 import pathlib
 import shutil
 import utils
@@ -26,11 +30,16 @@ def add_wcep_articles_to_clusters(wcep_path, url_to_cluster_idxs, clusters):
             c['wcep_articles_filled'].append(a)
 
 
-def add_cc_articles_to_clusters(clusters, cc_path, id_to_cluster_idx, tmp_clusters_path):
+def add_cc_articles_to_clusters(clusters, cc_path, id_to_cluster_idx, tmp_clusters_path,
+                                jobs=1):
     print('adding articles from CommonCrawl to clusters')
     n_clusters = len(clusters)
     n_clusters_done = 0
-    for i, a in enumerate(utils.read_jsonl(cc_path)):
+    if jobs > 1:
+        articles = utils.read_jsonl_parallel(cc_path, jobs)
+    else:
+        articles = utils.read_jsonl(cc_path)
+    for i, a in enumerate(articles):
         if i % 10000 == 0:
             print(f'{i} cc articles done, {n_clusters_done}/{n_clusters} clusters done')
         cluster_idx = id_to_cluster_idx[a['id']]
@@ -57,6 +66,164 @@ def add_cc_articles_to_clusters(clusters, cc_path, id_to_cluster_idx, tmp_cluste
     print(f'{i} cc articles done, {n_clusters_done}/{n_clusters} clusters done')
 
 
+# rough size in memory of decoded JSON articles per byte of JSON text
+MEMORY_PER_BYTE = 2
+
+
+class PartitionWriter:
+    """
+    Appends rows to partition files in part_dir. Rows are buffered in
+    memory and written in batches once the buffer holds buffer_bytes, with
+    one file open at a time, so the number of partitions is not limited by
+    open file handles. Counts the bytes spilled for each cluster.
+    """
+    def __init__(self, part_dir, buffer_bytes):
+        self.part_dir = part_dir
+        self.buffer_bytes = buffer_bytes
+        self.buffers = defaultdict(list)
+        self.n_buffered = 0
+        self.cluster_bytes = defaultdict(int)
+
+    def path(self, k):
+        return self.part_dir / f'{k}.jsonl'
+
+    def add(self, k, i, origin, line):
+        # the article's JSON line is written as is
+        row = f'[{i}, "{origin}", {line}]\n'
+        self.cluster_bytes[i] += len(row)
+        self.add_row(k, row)
+
+    def add_row(self, k, row):
+        self.buffers[k].append(row)
+        self.n_buffered += len(row)
+        if self.n_buffered >= self.buffer_bytes:
+            self.flush()
+
+    def flush(self):
+        for k, rows in self.buffers.items():
+            with open(self.path(k), 'a') as f:
+                f.write(''.join(rows))
+        self.buffers = defaultdict(list)
+        self.n_buffered = 0
+
+
+def load_partition(path):
+    """
+    WCEP articles (in file order) and CommonCrawl articles (by id, in file
+    order) of each cluster of one partition file.
+    """
+    filled = defaultdict(lambda: ([], {}))
+    if not path.exists():
+        return filled
+    for line in utils.read_lines(path):
+        i, origin, a = json.loads(line)
+        wcep_articles, cc_articles = filled[i]
+        if origin == 'wcep':
+            wcep_articles.append(a)
+        else:
+            cc_articles.setdefault(a['id'], a)
+    return filled
+
+
+def split_ranges(first, last, cluster_bytes, max_bytes):
+    """
+    Splits the clusters first..last-1 into contiguous ranges whose spilled
+    bytes are at most max_bytes, except for single clusters larger than
+    that.
+    """
+    ranges = []
+    start, size = first, 0
+    for i in range(first, last):
+        if i > start and size + cluster_bytes.get(i, 0) > max_bytes:
+            ranges.append((start, i))
+            start, size = i, 0
+        size += cluster_bytes.get(i, 0)
+    ranges.append((start, last))
+    return ranges
+
+
+def external_join(clusters, wcep_path, cc_path, url_to_cluster_idxs,
+                  id_to_cluster_idx, tmp_clusters_path, memory_budget):
+    """
+    Bounded-memory alternative to add_wcep_articles_to_clusters and
+    add_cc_articles_to_clusters. Articles are first spilled to partition
+    files on disk, each holding the articles of a contiguous range of
+    clusters, sized from the input files. Partitions that turn out larger
+    than memory_budget (in memory, estimated from the bytes spilled to
+    them) are split again into smaller cluster ranges. Then clusters are
+    assembled one partition at a time. As in the in-memory join, only
+    clusters whose CommonCrawl articles are all present are written, but
+    in dataset order.
+    """
+    n_clusters = len(clusters)
+    max_bytes = memory_budget // MEMORY_PER_BYTE
+    part_dir = tmp_clusters_path.parent / 'partitions'
+    part_dir.mkdir()
+    input_bytes = os.path.getsize(wcep_path) + os.path.getsize(cc_path)
+    n_parts = max(1, min(math.ceil(input_bytes / max_bytes), n_clusters))
+    print(f'spilling articles to {n_parts} partitions')
+    # the spill buffer takes a quarter of the budget
+    writer = PartitionWriter(part_dir, max_bytes // 4)
+
+    def part_start(k):
+        # first cluster i with i * n_parts // n_clusters == k
+        return -(-k * n_clusters // n_parts)
+
+    for line in utils.read_lines(wcep_path):
+        a = json.loads(line)
+        for i in url_to_cluster_idxs.get(a['archive_url'], []):
+            writer.add(i * n_parts // n_clusters, i, 'wcep', line)
+    for j, line in enumerate(utils.read_lines(cc_path)):
+        if j % 10000 == 0:
+            print(f'{j} cc articles done')
+        i = id_to_cluster_idx.get(json.loads(line)['id'])
+        if i is not None:
+            writer.add(i * n_parts // n_clusters, i, 'cc', line)
+    writer.flush()
+
+    print('assembling clusters')
+    n_clusters_done = 0
+    sub_dir = part_dir / 'split'
+    sub_dir.mkdir()
+    for k in range(n_parts):
+        first, last = part_start(k), part_start(k + 1)
+        path = writer.path(k)
+        ranges = split_ranges(first, last, writer.cluster_bytes, max_bytes)
+        if len(ranges) > 1:
+            # split an oversized partition by the bytes actually spilled
+            sub_writer = PartitionWriter(sub_dir, max_bytes // 4)
+            range_starts = [r[0] for r in ranges]
+            for line in utils.read_lines(path):
+                i = int(line[1:line.index(',')])
+                r = bisect.bisect_right(range_starts, i) - 1
+                sub_writer.add_row(r, line + '\n')
+            sub_writer.flush()
+            if path.exists():
+                path.unlink()
+            sub_paths = [sub_writer.path(r) for r in range(len(ranges))]
+        else:
+            sub_paths = [path]
+
+        for (range_first, range_last), sub_path in zip(ranges, sub_paths):
+            filled = load_partition(sub_path)
+            for i in range(range_first, range_last):
+                c = clusters[i]
+                wcep_articles, cc_articles = filled.pop(i, ([], {}))
+                if c['cc_ids'] != set(cc_articles):
+                    continue
+                if wcep_articles:
+                    c['wcep_articles_filled'] = wcep_articles
+                c['cc_articles_filled'] = list(cc_articles.values())
+                del c['cc_ids'], c['cc_ids_filled']
+                utils.write_jsonl([c], tmp_clusters_path, mode='a')
+                clusters[i] = None
+                n_clusters_done += 1
+            if sub_path.exists():
+                sub_path.unlink()
+    shutil.rmtree(part_dir)
+    print(f'{n_clusters_done}/{n_clusters} clusters done')
+
+
 def split_dataset(outdir, tmp_clusters_path):
     print('splitting dataset into train/val/test...')
     for i, c in enumerate(utils.read_jsonl(tmp_clusters_path)):
@@ -97,6 +264,78 @@ def cleanup_clusters(path, tmp_path):
     shutil.move(tmp_path, path)
 
 
+def article_key(a):
+    # CommonCrawl articles have ids, WCEP articles only URLs
+    return a['id'] if 'id' in a else a['archive_url']
+
+
+class ArticleTableWriter:
+    """
+    Writes each distinct article once to articles.jsonl.gz, in gzip members
+    of about block_bytes of JSON lines each. The file is a normal
+    .jsonl.gz file, and articles.index.json maps every article key to its
+    member and line offset, so that single articles can be read without
+    decompressing the rest of the table.
+    """
+    def __init__(self, outdir, block_bytes=2 ** 20):
+        self.path = outdir / 'articles.jsonl.gz'
+        self.index_path = outdir / 'articles.index.json'
+        self.block_bytes = block_bytes
+        self.f = open(self.path, 'wb')
+        self.block = []
+        self.block_len = 0
+        self.member_offsets = [0]
+        self.locations = {}
+
+    def add(self, a):
+        key = article_key(a)
+        if key not in self.locations:
+            line = json.dumps(a).encode('utf-8') + b'\n'
+            self.locations[key] = [len(self.member_offsets) - 1,
+                                   self.block_len]
+            self.block.append(line)
+            self.block_len += len(line)
+            if self.block_len >= self.block_bytes:
+                self._flush()
+        return key
+
+    def _flush(self):
+        if not self.block:
+            return
+        self.f.write(gzip.compress(b''.join(self.block)))
+        self.member_offsets.append(self.f.tell())
+        self.block = []
+        self.block_len = 0
+
+    def close(self):
+        self._flush()
+        self.f.close()
+        with open(self.index_path, 'w') as f:
+            f.write(json.dumps({
+                'member_offsets': self.member_offsets,
+                'articles': self.locations,
+            }))
+
+
+def normalize_splits(outdir, fns, tmp_path):
+    """
+    Moves the articles of the clusters in outdir/fns to a shared article
+    table and replaces them by their keys ('article_ids').
+    """
+    table = ArticleTableWriter(outdir)
+    for fn in fns:
+        print('normalizing:', fn)
+        for i, c in enumerate(utils.read_jsonl(outdir / fn)):
+            if i % 1000 == 0:
+                print(i, 'clusters done')
+            articles = c.pop('articles')
+            c['article_ids'] = [table.add(a) for a in articles]
+            utils.write_jsonl([c], tmp_path, mode='a')
+        shutil.move(tmp_path, outdir / fn)
+    table.close()
+    print(len(table.locations), 'distinct articles')
+
+
 def main(args):
     outdir = pathlib.Path(args.o)
     if outdir.exists():
@@ -121,23 +360,35 @@ def main(args):
         clusters
     )
 
-    # add articles from WCEP to clusters, using URLs
-    add_wcep_articles_to_clusters(
-        args.wcep_articles, url_to_cluster_idxs, clusters
-    )
+    if args.memory_budget is not None:
+        # join articles and clusters via partitions on disk
+        external_join(
+            clusters, args.wcep_articles, args.cc_articles,
+            url_to_cluster_idxs, id_to_cluster_idx, tmp_clusters_path,
+            int(args.memory_budget * 2 ** 20)
+        )
+    else:
+        # add articles from WCEP to clusters, using URLs
+        add_wcep_articles_to_clusters(
+            args.wcep_articles, url_to_cluster_idxs, clusters
+        )
 
-    # add articles from CommonCrawl to clusters, using IDs
-    add_cc_articles_to_clusters(
-        clusters, args.cc_articles, id_to_cluster_idx, tmp_clusters_path
-    )
+        # add articles from CommonCrawl to clusters, using IDs
+        add_cc_articles_to_clusters(
+            clusters, args.cc_articles, id_to_cluster_idx, tmp_clusters_path,
+            args.jobs
+        )
 
     # split clusters into separate train/val/test files
     split_dataset(outdir, tmp_clusters_path)
     tmp_clusters_path.unlink()
 
-    for fn in ['train.jsonl', 'val.jsonl', 'test.jsonl']:
+    fns = ['train.jsonl', 'val.jsonl', 'test.jsonl']
+    for fn in fns:
         cleanup_clusters(outdir / fn, tmp_clusters_path)
 
+    if args.normalized:
+        normalize_splits(outdir, fns, tmp_clusters_path)
 
 
 if __name__ == '__main__':
@@ -147,4 +398,13 @@ if __name__ == '__main__':
     parser.add_argument('--cc-articles', required=True)
     parser.add_argument('--max-cluster-size', type=int, default=-1)
     parser.add_argument('--o', required=True)
-    main(parser.parse_args())
+    # store each article once in articles.jsonl.gz, clusters refer to them
+    parser.add_argument('--normalized', action='store_true')
+    # processes decoding the CommonCrawl articles
+    parser.add_argument('--jobs', type=int, default=1)
+    # memory budget in MB for article bodies, joins via disk partitions
+    parser.add_argument('--memory-budget', type=float)
+    args = parser.parse_args()
+    if args.memory_budget is not None and args.jobs > 1:
+        parser.error('--jobs is not supported with --memory-budget')
+    main(args)
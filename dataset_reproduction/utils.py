@@ -1,4 +1,11 @@
 import json
+import gzip
+import collections
+import multiprocessing
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def read_lines(path):
@@ -18,4 +25,47 @@ def write_jsonl(items, path, mode='a'):
     lines = [json.dumps(x) for x in items]
     with open(path, mode) as f:
         f.write('\n'.join(lines) + '\n')
-        
+
+
+def json_loads(line):
+    """
+    json.loads, with orjson if it is installed, falling back to json for
+    inputs orjson rejects, such as lone surrogates.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except ValueError:
+            pass
+    return json.loads(line)
+
+
+def _decode_lines(data):
+    return [json_loads(line) for line in data.split(b'\n') if line.strip()]
+
+
+def _chunks(path, chunk_bytes):
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            yield b''.join(lines)
+
+
+def read_jsonl_parallel(path, jobs=4, chunk_bytes=2 ** 22):
+    """
+    Reads a .jsonl or .jsonl.gz file like read_jsonl, but decodes chunks
+    of about chunk_bytes in a pool of `jobs` processes, with at most
+    2 * jobs chunks in flight. Items are yielded in file order.
+    experiments/parallel_jsonl.py has a more complete version.
+    """
+    with multiprocessing.Pool(processes=jobs) as pool:
+        pending = collections.deque()
+        for data in _chunks(path, chunk_bytes):
+            pending.append(pool.apply_async(_decode_lines, (data,)))
+            if len(pending) >= 2 * jobs:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
@@ -1,13 +1,23 @@
+import argparse
 import utils
+import heapq
 import random
 import collections
 import numpy as np
-import networkx as nx
+from scipy import sparse
 import warnings
-from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.cluster import MiniBatchKMeans
 from summarizer import Summarizer
+from redundancy import RedundancyIndex
+from pagerank import pagerank, pagerank_batch
+from tfidf import CorpusTfidf
+from profiling import Profiler
+from dedup import ArticleDeduplicator
+from dataset import ClusterQuery
+from candidates import CandidatePruner
+from similarity import BlockwiseSimilarity, column
+from lsh import LSHSimilarity
 
 
 warnings.filterwarnings('ignore', category=RuntimeWarning)
@@ -63,12 +73,18 @@ class RandomLead(Summarizer):
                   min_sent_tokens=7,
                   max_sent_tokens=40):
 
+        # articles are preprocessed one at a time until a summary is found,
+        # unless near-duplicates must be removed from the whole cluster
+        lazy = self.deduplicator is None
+        if not lazy:
+            articles = self._preprocess(articles)
         article_idxs = list(range(len(articles)))
         random.shuffle(article_idxs)
         summary = ''
         for i in article_idxs:
             a = articles[i]
-            a = self._preprocess([a])[0]
+            if lazy:
+                a = self._preprocess([a])[0]
             sents = a.sents
             if in_titles == False or out_titles == False:
                 sents = [s for s in sents if not s.is_title]
@@ -91,38 +107,56 @@ class RandomLead(Summarizer):
 
 
 class TextRankSummarizer(Summarizer):
-    def __init__(self, max_redundancy=0.5):
+    def __init__(self, max_redundancy=0.5, pagerank_threshold=None,
+                 pagerank_top_k=None, tfidf=None, pruner=None,
+                 similarity=None):
         self.max_redundancy = max_redundancy
+        self.tfidf = tfidf
+        self.pruner = pruner
+        # similarity.BlockwiseSimilarity, default: exact cosine_similarity
+        self.similarity = similarity
+        self.pagerank_threshold = pagerank_threshold
+        self.pagerank_top_k = pagerank_top_k
 
     def _compute_page_rank(self, S):
-        nodes = list(range(S.shape[0]))
-        graph = nx.from_numpy_matrix(S)
-        pagerank = nx.pagerank(graph, weight='weight')
-        scores = [pagerank[i] for i in nodes]
-        return scores
-
-    def summarize(self,
-                  articles,
-                  max_len=40,
-                  len_type='words',
-                  in_titles=False,
-                  out_titles=False,
-                  min_sent_tokens=7,
-                  max_sent_tokens=40):
-
+        with self._stage('pagerank', n_sents=S.shape[0], nnz=S.nnz):
+            scores = pagerank(
+                S,
+                threshold=self.pagerank_threshold,
+                top_k=self.pagerank_top_k
+            )
+        return scores.tolist()
+
+    def _build_graph(self, articles, in_titles, out_titles, min_sent_tokens,
+                     max_sent_tokens):
         articles = self._preprocess(articles)
         sents = [s for a in articles for s in a.sents]
         if in_titles == False:
             sents = [s for s in sents if not s.is_title]
         sents = self._deduplicate(sents)
-        sent_lens = [self._sent_len(s, len_type) for s in sents]
-        raw_sents = [s.text for s in sents]
-
-        vectorizer = TfidfVectorizer(lowercase=True, stop_words='english')
-        X = vectorizer.fit_transform(raw_sents)
-        S = cosine_similarity(X)
+        sents = self._prune(
+            sents, out_titles, min_sent_tokens, max_sent_tokens)
+        if len(sents) == 0:
+            return sents, sparse.csr_matrix((0, 0))
+
+        X = self._vectorize(sents)
+        with self._stage('similarity', n_sents=len(sents)):
+            if self.similarity is None:
+                S = cosine_similarity(X, dense_output=False)
+            else:
+                S, _ = self.similarity.pairwise(X)
+        return sents, S
+
+    def _select(self,
+                sents,
+                scores,
+                max_len,
+                len_type,
+                out_titles,
+                min_sent_tokens,
+                max_sent_tokens):
 
-        scores = self._compute_page_rank(S)
+        sent_lens = [self._sent_len(s, len_type) for s in sents]
         scored = sorted(enumerate(scores), key=lambda x: x[1], reverse=True)
 
         if not out_titles:
@@ -131,26 +165,70 @@ class TextRankSummarizer(Summarizer):
 
         current_len = 0
         selected = []
+        redundancy = RedundancyIndex(sents)
         for i, _ in scored:
             new_len = current_len + sent_lens[i]
             if new_len <= max_len:
-                if self._is_redundant(
-                        sents, selected, i, self.max_redundancy):
+                if redundancy.is_redundant(i, self.max_redundancy):
                     continue
                 if not (min_sent_tokens <= len(
                         sents[i].words) <= max_sent_tokens):
                     continue
 
                 selected.append(i)
+                redundancy.add(i)
                 current_len = new_len
 
         summary_sents = [sents[i].text for i in selected]
         return ' '.join(summary_sents)
 
+    def summarize(self,
+                  articles,
+                  max_len=40,
+                  len_type='words',
+                  in_titles=False,
+                  out_titles=False,
+                  min_sent_tokens=7,
+                  max_sent_tokens=40):
+
+        sents, S = self._build_graph(articles, in_titles, out_titles,
+                                     min_sent_tokens, max_sent_tokens)
+        scores = self._compute_page_rank(S)
+        with self._stage('select', n_sents=len(sents)):
+            return self._select(sents, scores, max_len, len_type,
+                                out_titles, min_sent_tokens, max_sent_tokens)
+
+    def summarize_many(self,
+                       clusters,
+                       max_len=40,
+                       len_type='words',
+                       in_titles=False,
+                       out_titles=False,
+                       min_sent_tokens=7,
+                       max_sent_tokens=40):
+        """
+        Summarizes several clusters (lists of articles), ranking all their
+        sentence graphs in one block-diagonal PageRank solve.
+        """
+        graphs = [self._build_graph(articles, in_titles, out_titles,
+                                    min_sent_tokens, max_sent_tokens)
+                  for articles in clusters]
+        with self._stage('pagerank_batch', n_clusters=len(graphs)):
+            all_scores = pagerank_batch(
+                [S for _, S in graphs],
+                threshold=self.pagerank_threshold,
+                top_k=self.pagerank_top_k
+            )
+        return [self._select(sents, scores.tolist(), max_len, len_type,
+                             out_titles, min_sent_tokens, max_sent_tokens)
+                for (sents, _), scores in zip(graphs, all_scores)]
+
 
 class CentroidSummarizer(Summarizer):
-    def __init__(self, max_redundancy=0.5):
+    def __init__(self, max_redundancy=0.5, tfidf=None, pruner=None):
         self.max_redundancy = max_redundancy
+        self.tfidf = tfidf
+        self.pruner = pruner
 
     def summarize(self,
                   articles,
@@ -166,17 +244,20 @@ class CentroidSummarizer(Summarizer):
         if in_titles == False:
             sents = [s for s in sents if not s.is_title]
         sents = self._deduplicate(sents)
+        sents = self._prune(
+            sents, out_titles, min_sent_tokens, max_sent_tokens)
         sent_lens = [self._sent_len(s, len_type) for s in sents]
-        raw_sents = [s.text for s in sents]
 
-        vectorizer = TfidfVectorizer(lowercase=True, stop_words='english')
         try:
-            X = vectorizer.fit_transform(raw_sents)
+            X = self._vectorize(sents)
         except:
             return ''
+        if X.shape[0] == 0:
+            return ''
 
-        centroid = X.mean(0)
-        scores = cosine_similarity(X, centroid)
+        with self._stage('similarity', n_sents=len(sents)):
+            centroid = X.mean(0)
+            scores = cosine_similarity(X, centroid)
         scored = sorted(enumerate(scores), key=lambda x: x[1], reverse=True)
 
         if not out_titles:
@@ -185,18 +266,20 @@ class CentroidSummarizer(Summarizer):
 
         current_len = 0
         selected = []
-        for i, _ in scored:
-            new_len = current_len + sent_lens[i]
-            if new_len <= max_len:
-                if self._is_redundant(
-                    sents, selected, i, self.max_redundancy):
-                    continue
-                if not (min_sent_tokens <= len(
-                        sents[i].words) <= max_sent_tokens):
-                    continue
+        redundancy = RedundancyIndex(sents)
+        with self._stage('select', n_sents=len(sents)):
+            for i, _ in scored:
+                new_len = current_len + sent_lens[i]
+                if new_len <= max_len:
+                    if redundancy.is_redundant(i, self.max_redundancy):
+                        continue
+                    if not (min_sent_tokens <= len(
+                            sents[i].words) <= max_sent_tokens):
+                        continue
 
-                selected.append(i)
-                current_len = new_len
+                    selected.append(i)
+                    redundancy.add(i)
+                    current_len = new_len
 
         summary_sents = [sents[i].text for i in selected]
         return ' '.join(summary_sents)
@@ -208,10 +291,19 @@ class SubmodularSummarizer(Summarizer):
     a submodular function, in this case two functions representing
     coverage and diversity of the sentence combination.
     """
-    def __init__(self, a=5, div_weight=6, cluster_factor=0.2):
+    def __init__(self, a=5, div_weight=6, cluster_factor=0.2,
+                 optimizer='lazy', tfidf=None, pruner=None,
+                 similarity=None):
         self.a = a
         self.div_weight = div_weight
         self.cluster_factor = cluster_factor
+        if optimizer not in ('lazy', 'naive'):
+            raise ValueError('optimizer must be in (lazy|naive)')
+        self.optimizer = optimizer
+        self.tfidf = tfidf
+        self.pruner = pruner
+        # similarity.BlockwiseSimilarity, default: exact cosine_similarity
+        self.similarity = similarity
 
     def cluster_sentences(self, X):
         n = X.shape[0]
@@ -222,7 +314,8 @@ class SubmodularSummarizer(Summarizer):
             n_clusters=n_clusters,
             init_size=3 * n_clusters
         )
-        labels = clusterer.fit_predict(X)
+        with self._stage('kmeans', n_sents=n, n_clusters=n_clusters):
+            labels = clusterer.fit_predict(X)
         i_to_label = dict((i, l) for i, l in enumerate(labels))
         return i_to_label
 
@@ -265,6 +358,27 @@ class SubmodularSummarizer(Summarizer):
                  out_titles,
                  min_sent_tokens,
                  max_sent_tokens):
+        if self.optimizer == 'lazy':
+            optimize = self._optimize_lazy
+        else:
+            optimize = self._optimize_naive
+        return optimize(
+            sents, max_len, len_type, ix_to_label,
+            pairwise_sims, sent_coverages, avg_sent_sims,
+            out_titles, min_sent_tokens, max_sent_tokens
+        )
+
+    def _optimize_naive(self,
+                 sents,
+                 max_len,
+                 len_type,
+                 ix_to_label,
+                 pairwise_sims,
+                 sent_coverages,
+                 avg_sent_sims,
+                 out_titles,
+                 min_sent_tokens,
+                 max_sent_tokens):
 
         alpha = self.a / len(sents)
         sent_lens = [self._sent_len(s, len_type) for s in sents]
@@ -308,6 +422,127 @@ class SubmodularSummarizer(Summarizer):
         best_selection = scored_selections[0][0]
         return best_selection
 
+    def _coverage_gains(self,
+                        summary_coverages,
+                        max_coverages,
+                        pairwise_sims,
+                        candidates,
+                        block_size=256):
+        """
+        Coverage gains of adding each candidate to the summary, computed
+        in blocks of candidates to bound memory. With a sparse (CSC)
+        pairwise_sims, only the nonzero similarities of each candidate are
+        visited, since all other sentences gain nothing.
+        """
+        capped = np.minimum(summary_coverages, max_coverages)
+        gains = np.empty(len(candidates))
+        for k in range(0, len(candidates), block_size):
+            cols = candidates[k:k + block_size]
+            if sparse.issparse(pairwise_sims):
+                block = pairwise_sims[:, cols]
+                rows = block.indices
+                delta = np.minimum(summary_coverages[rows] + block.data,
+                                   max_coverages[rows]) - capped[rows]
+                col_ids = np.repeat(np.arange(len(cols)),
+                                    np.diff(block.indptr))
+                gains[k:k + block_size] = np.bincount(
+                    col_ids, weights=delta, minlength=len(cols))
+                continue
+            new_cov = np.minimum(
+                summary_coverages[:, None] + pairwise_sims[:, cols],
+                max_coverages[:, None]
+            )
+            gains[k:k + block_size] = (new_cov - capped[:, None]).sum(0)
+        return gains
+
+    def _optimize_lazy(self,
+                       sents,
+                       max_len,
+                       len_type,
+                       ix_to_label,
+                       pairwise_sims,
+                       sent_coverages,
+                       avg_sent_sims,
+                       out_titles,
+                       min_sent_tokens,
+                       max_sent_tokens):
+        """
+        Same greedy selection as _optimize_naive, but with the summary's
+        coverage of each sentence and the diversity sum of each cluster kept
+        as running state, so that marginal gains are computed as vector
+        operations. Since the objective is submodular, gains only decrease
+        as the summary grows, and candidates are kept in a priority queue
+        keyed by their last computed gain (lazy greedy): only the top of
+        the queue needs to be re-evaluated in each step.
+        """
+        n = len(sents)
+        alpha = self.a / n
+        if sparse.issparse(pairwise_sims):
+            # column slices are cheap in CSC format
+            pairwise_sims = pairwise_sims.tocsc()
+        sent_lens = [self._sent_len(s, len_type) for s in sents]
+        max_coverages = alpha * np.asarray(sent_coverages).ravel()
+        avg_sent_sims = np.asarray(avg_sent_sims).ravel()
+        labels = np.array([ix_to_label[i] for i in range(n)])
+        summary_coverages = np.zeros(n)
+        cluster_scores = collections.defaultdict(float)
+
+        candidates = []
+        for i, s in enumerate(sents):
+            bad_length = not (min_sent_tokens <= len(s.words)
+                              <= max_sent_tokens)
+            if bad_length:
+                continue
+            elif out_titles == False and s.is_title:
+                continue
+            candidates.append(i)
+
+        def diversity_gain(i):
+            score = cluster_scores[labels[i]]
+            return np.sqrt(score + avg_sent_sims[i]) - np.sqrt(score)
+
+        gains = self._coverage_gains(
+            summary_coverages, max_coverages, pairwise_sims, candidates)
+        # heap entries: (-gain, index, step at which gain was computed)
+        heap = [(-(g + self.div_weight * diversity_gain(i)), i, 0)
+                for i, g in zip(candidates, gains)]
+        heapq.heapify(heap)
+
+        current_len = 0
+        current_score = 0
+        step = 0
+        selected = []
+        scored_selections = []
+
+        while current_len < max_len and len(heap) > 0:
+            while len(heap) > 0:
+                _, i, computed_at = heap[0]
+                if current_len + sent_lens[i] > max_len:
+                    # the summary only grows, so i will never fit again
+                    heapq.heappop(heap)
+                elif computed_at < step:
+                    cov_gain = self._coverage_gains(
+                        summary_coverages, max_coverages, pairwise_sims, [i])
+                    gain = cov_gain[0] + self.div_weight * diversity_gain(i)
+                    heapq.heapreplace(heap, (-gain, i, step))
+                else:
+                    break
+            if len(heap) == 0:
+                break
+
+            neg_gain, best_idx, _ = heapq.heappop(heap)
+            current_score += -neg_gain
+            selected.append(best_idx)
+            scored_selections.append((list(selected), current_score))
+            current_len += sent_lens[best_idx]
+            summary_coverages += column(pairwise_sims, best_idx)
+            cluster_scores[labels[best_idx]] += avg_sent_sims[best_idx]
+            step += 1
+
+        scored_selections.sort(key=lambda x: x[1], reverse=True)
+        best_selection = scored_selections[0][0]
+        return best_selection
+
     def summarize(self,
                   articles,
                   max_len=40,
@@ -322,21 +557,150 @@ class SubmodularSummarizer(Summarizer):
         if in_titles == False:
             sents = [s for s in sents if not s.is_title]
         sents = self._deduplicate(sents)
-        raw_sents = [s.text for s in sents]
+        sents = self._prune(
+            sents, out_titles, min_sent_tokens, max_sent_tokens)
+        if len(sents) == 0:
+            return ''
 
-        vectorizer = TfidfVectorizer(lowercase=True, stop_words='english')
-        X = vectorizer.fit_transform(raw_sents)
+        X = self._vectorize(sents)
 
         ix_to_label = self.cluster_sentences(X)
-        pairwise_sims = cosine_similarity(X)
-        sent_coverages = pairwise_sims.sum(0)
-        avg_sent_sims = sent_coverages / len(sents)
-
-        selected = self.optimize(
-            sents, max_len, len_type, ix_to_label,
-            pairwise_sims, sent_coverages, avg_sent_sims,
-            out_titles, min_sent_tokens, max_sent_tokens
-        )
+        with self._stage('similarity', n_sents=len(sents)):
+            if self.similarity is None:
+                pairwise_sims = cosine_similarity(X)
+                sent_coverages = pairwise_sims.sum(0)
+            else:
+                pairwise_sims, sent_coverages = self.similarity.pairwise(X)
+            avg_sent_sims = sent_coverages / len(sents)
+
+        with self._stage('optimize', n_sents=len(sents),
+                         optimizer=self.optimizer):
+            selected = self.optimize(
+                sents, max_len, len_type, ix_to_label,
+                pairwise_sims, sent_coverages, avg_sent_sims,
+                out_titles, min_sent_tokens, max_sent_tokens
+            )
 
         summary = [sents[i].text for i in selected]
         return ' '.join(summary)
+
+
+def main(args):
+    tfidf = None if args.tfidf is None else CorpusTfidf.load(args.tfidf)
+    pruner = CandidatePruner.from_spec(args.prune)
+    similarity = None
+    if args.memory_budget is not None or args.sim_threshold is not None \
+            or args.sim_top_k is not None:
+        similarity = BlockwiseSimilarity(
+            threshold=args.sim_threshold,
+            top_k=args.sim_top_k,
+            memory_budget=(args.memory_budget or 256) * 2 ** 20
+        )
+    if args.lsh is not None:
+        similarity = LSHSimilarity.from_spec(args.lsh)
+    if args.mode == 'predict-random':
+        summarizer = RandomBaseline()
+    elif args.mode == 'predict-random-lead':
+        summarizer = RandomLead()
+    elif args.mode == 'predict-textrank':
+        summarizer = TextRankSummarizer(
+            max_redundancy=args.max_redundancy,
+            tfidf=tfidf,
+            pruner=pruner,
+            similarity=similarity
+        )
+    elif args.mode == 'predict-centroid':
+        summarizer = CentroidSummarizer(
+            max_redundancy=args.max_redundancy,
+            tfidf=tfidf,
+            pruner=pruner
+        )
+    elif args.mode == 'predict-submodular':
+        summarizer = SubmodularSummarizer(
+            tfidf=tfidf,
+            pruner=pruner,
+            similarity=similarity
+        )
+    else:
+        raise ValueError('Unknown or unspecified --mode: ' + args.mode)
+
+    summarize_settings = utils.args_to_summarize_settings(args)
+    profiler = None
+    if args.profile is not None or args.trace is not None:
+        profiler = Profiler()
+    Summarizer.summarize_dataset(
+        summarizer,
+        dataset_path=args.dataset,
+        pred_path=args.preds,
+        summarize_settings=summarize_settings,
+        start=args.start,
+        stop=args.stop,
+        batchsize=args.batchsize,
+        jobs=args.jobs,
+        override=args.override,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        compact=args.compact,
+        vocab_path=args.vocab,
+        profiler=profiler,
+        deduplicator=ArticleDeduplicator.from_spec(args.dedup),
+        query=ClusterQuery.from_spec(args.where),
+        read_jobs=args.read_jobs
+    )
+    if profiler is not None:
+        profiler.print_summary()
+        if args.profile is not None:
+            profiler.to_json(args.profile)
+        if args.trace is not None:
+            profiler.to_chrome_trace(args.trace)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode')
+    parser.add_argument('--dataset')
+    parser.add_argument('--preds')
+    parser.add_argument('--start', type=int, default=-1)
+    parser.add_argument('--stop', type=int, default=-1)
+    parser.add_argument('--max-len', type=int, default=40)
+    parser.add_argument('--len-type', default='words')
+    parser.add_argument('--in-titles', action='store_true')
+    parser.add_argument('--out-titles', action='store_true')
+    parser.add_argument('--min-sent-tokens', type=int, default=7)
+    parser.add_argument('--max-sent-tokens', type=int, default=60)
+    parser.add_argument('--max-redundancy', type=float, default=0.5)
+    # IDF statistics fitted with tfidf.py, default: per-cluster IDF
+    parser.add_argument('--tfidf')
+    # candidate pruning before scoring, e.g. lengths,per_article=10,top_n=200
+    parser.add_argument('--prune', default='none')
+    # blockwise sparse similarities for textrank and submodular, with a
+    # memory budget in MB per worker for computing them and optional
+    # truncation; without truncation all nonzero similarities are kept
+    parser.add_argument('--memory-budget', type=int)
+    parser.add_argument('--sim-threshold', type=float)
+    parser.add_argument('--sim-top-k', type=int)
+    # approximate similarities for textrank and submodular instead, e.g.
+    # simhash,bands=16,rows=8 or minhash,bands=20,rows=5
+    parser.add_argument('--lsh')
+    parser.add_argument('--batchsize', type=int, default=32)
+    parser.add_argument('--jobs', type=int, default=4)
+    # processes decoding the dataset, for splits with very large clusters
+    parser.add_argument('--read-jobs', type=int, default=1)
+    parser.add_argument('--override', action='store_true')
+    parser.add_argument('--cache-dir')
+    # bytes of cached clusters per tokenizer setting in --cache-dir
+    parser.add_argument('--cache-size', type=int, default=2 ** 32)
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--vocab')
+    # collapse near-duplicate articles, e.g. threshold=0.8,shingle=5
+    parser.add_argument('--dedup', default='none')
+    # only clusters matching metadata conditions, e.g.
+    # date_from=2019,category=Armed conflicts and attacks,min_articles=20
+    parser.add_argument('--where', default='none')
+    # per-stage timings as JSON and/or Chrome trace
+    parser.add_argument('--profile')
+    parser.add_argument('--trace')
+    args = parser.parse_args()
+    if args.read_jobs > 1 and args.where != 'none':
+        parser.error('--read-jobs is not supported with --where')
+    main(args)
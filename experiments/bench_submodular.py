@@ -0,0 +1,62 @@
+import argparse
+import time
+import numpy as np
+from scipy import sparse
+from sklearn.metrics.pairwise import cosine_similarity
+from data import Sentence
+from baselines import SubmodularSummarizer
+
+
+def make_inputs(n_sents, vocab_size=5000, seed=0):
+    """
+    Random sentences with 7-40 tokens and their pairwise cosine
+    similarities, as SubmodularSummarizer.summarize would compute them.
+    """
+    rng = np.random.RandomState(seed)
+    lens = rng.randint(7, 41, size=n_sents)
+    rows = np.repeat(np.arange(n_sents), lens)
+    # Zipf-distributed word ids, like in natural text
+    cols = np.minimum(rng.zipf(1.3, size=lens.sum()), vocab_size) - 1
+    X = sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(n_sents, vocab_size))
+    sents = [Sentence(text=str(i), words=['w'] * l, position=i)
+             for i, l in enumerate(lens)]
+    pairwise_sims = cosine_similarity(X)
+    sent_coverages = pairwise_sims.sum(0)
+    avg_sent_sims = sent_coverages / n_sents
+    n_clusters = max(1, round(0.2 * n_sents))
+    ix_to_label = dict(enumerate(rng.randint(0, n_clusters, size=n_sents)))
+    return sents, ix_to_label, pairwise_sims, sent_coverages, avg_sent_sims
+
+
+def run(optimizer, inputs, max_len):
+    sents, ix_to_label, pairwise_sims, sent_coverages, avg_sent_sims = inputs
+    summarizer = SubmodularSummarizer(optimizer=optimizer)
+    t1 = time.time()
+    selected = summarizer.optimize(
+        sents, max_len, 'words', ix_to_label, pairwise_sims,
+        sent_coverages, avg_sent_sims, False, 7, 40)
+    return selected, time.time() - t1
+
+
+def main(args):
+    for n_sents in args.sizes:
+        inputs = make_inputs(n_sents, seed=args.seed)
+        lazy_selected, lazy_time = run('lazy', inputs, args.max_len)
+        print(f'n={n_sents} lazy: {round(lazy_time, 3)} seconds')
+        if n_sents <= args.max_naive:
+            naive_selected, naive_time = run('naive', inputs, args.max_len)
+            print(f'n={n_sents} naive: {round(naive_time, 3)} seconds, '
+                  f'speedup: {round(naive_time / lazy_time, 1)}x, '
+                  f'same selection: {naive_selected == lazy_selected}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 2000, 5000, 10000])
+    parser.add_argument('--max-len', type=int, default=40)
+    # the naive optimizer takes hours on the largest clusters
+    parser.add_argument('--max-naive', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,363 @@
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import utils
+from baselines import TextRankSummarizer, CentroidSummarizer, \
+    SubmodularSummarizer
+from oracles import Oracle, LeadOracle
+from candidates import CandidatePruner
+from similarity import BlockwiseSimilarity
+from lsh import LSHSimilarity
+from dataset import read_clusters, ClusterQuery
+from profiling import Profiler
+import rouge
+
+
+# stages are the ones the systems record in a profiling.Profiler
+SYSTEMS = {
+    'textrank': TextRankSummarizer,
+    'centroid': CentroidSummarizer,
+    'submodular': SubmodularSummarizer,
+    'oracle': Oracle,
+    'lead-oracle': LeadOracle,
+}
+ORACLES = ('oracle', 'lead-oracle')
+# systems that build dense sentence x sentence matrices
+DENSE_SYSTEMS = ('submodular',)
+# systems that take a similarity backend
+SIMILARITY_SYSTEMS = ('textrank', 'submodular')
+
+SETTINGS = {
+    'max_len': 40, 'len_type': 'words',
+    'in_titles': False, 'out_titles': False,
+    'min_sent_tokens': 7, 'max_sent_tokens': 60,
+}
+
+
+class SyntheticWCEP:
+    """
+    Generates clusters shaped like WCEP clusters without any data: words
+    are drawn from a Zipf distribution over random pseudo-words, mixed
+    with topic words of the cluster so that sentences of a cluster
+    overlap. Sentence lengths are log-normal, articles have a title and
+    5-40 sentences with occasional line breaks, and some articles are
+    exact or near duplicates of earlier ones, as are many articles in
+    WCEP clusters. The reference summary mixes copied and new sentences.
+    """
+    def __init__(self, vocab_size=20000, zipf_a=1.1, topic_size=40,
+                 topic_prob=0.3, dup_prob=0.1, seed=0):
+        rng = np.random.RandomState(seed)
+        letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+        self.words = sorted(set(
+            ''.join(rng.choice(letters, size=rng.randint(2, 11)))
+            for _ in range(vocab_size)))
+        rng.shuffle(self.words)
+        probs = 1. / np.arange(1, len(self.words) + 1) ** zipf_a
+        self.cum_probs = np.cumsum(probs / probs.sum())
+        self.topic_size = topic_size
+        self.topic_prob = topic_prob
+        self.dup_prob = dup_prob
+
+    def _sent(self, rng, topic, n_words, period=True):
+        ids = np.searchsorted(self.cum_probs, rng.random_sample(n_words))
+        ids = np.minimum(ids, len(self.words) - 1)
+        from_topic = rng.random_sample(n_words) < self.topic_prob
+        ids[from_topic] = rng.choice(topic, size=from_topic.sum())
+        words = [self.words[i] for i in ids]
+        words[0] = words[0].capitalize()
+        for i in range(2, n_words - 1, 9):
+            if rng.random_sample() < 0.3:
+                words[i] += ','
+        return ' '.join(words) + ('.' if period else '')
+
+    def _sent_len(self, rng):
+        return int(np.clip(rng.lognormal(np.log(20), 0.5), 3, 80))
+
+    def _article(self, rng, topic):
+        sents = [self._sent(rng, topic, self._sent_len(rng))
+                 for _ in range(rng.randint(5, 41))]
+        parts = []
+        for s in sents:
+            parts.append(s)
+            parts.append('\n' if rng.random_sample() < 0.2 else ' ')
+        return {
+            'title': self._sent(rng, topic, rng.randint(6, 15), False),
+            'text': ''.join(parts[:-1])
+        }
+
+    def _near_duplicate(self, rng, topic, article):
+        lines = article['text'].split('\n')
+        i = rng.randint(len(lines))
+        lines[i] = self._sent(rng, topic, self._sent_len(rng))
+        return {'title': article['title'], 'text': '\n'.join(lines)}
+
+    def cluster(self, n_articles, seed):
+        rng = np.random.RandomState(seed)
+        topic = rng.randint(0, len(self.words), size=self.topic_size)
+        articles = []
+        for _ in range(n_articles):
+            if articles and rng.random_sample() < self.dup_prob:
+                original = articles[rng.randint(len(articles))]
+                if rng.random_sample() < 0.5:
+                    articles.append(dict(original))
+                else:
+                    articles.append(
+                        self._near_duplicate(rng, topic, original))
+            else:
+                articles.append(self._article(rng, topic))
+        summary = [self._sent(rng, topic, self._sent_len(rng))]
+        summary.append(
+            articles[0]['text'].split('\n')[0].split('. ')[0] + '.')
+        return {'id': f'synthetic-{n_articles}-{seed}',
+                'summary': ' '.join(summary),
+                'articles': articles}
+
+
+def attach_profiler(system):
+    """
+    Makes a system instance record its stages in a new Profiler and
+    returns it. Oracles record through their inner summarizer.
+    """
+    profiler = Profiler()
+    getattr(system, 'summarizer', system).profiler = profiler
+    return profiler
+
+
+def run_system(system, cluster, oracle):
+    if oracle:
+        return system.summarize(
+            cluster['summary'], cluster['articles'], **SETTINGS)
+    return system.summarize(cluster['articles'], **SETTINGS)
+
+
+def similarity_from_spec(spec):
+    """
+    'exact', or a BlockwiseSimilarity or LSHSimilarity spec string.
+    """
+    method = spec.split(',')[0]
+    if method == 'exact':
+        return None
+    if method == 'blockwise':
+        return BlockwiseSimilarity.from_spec(spec)
+    return LSHSimilarity.from_spec(spec)
+
+
+def benchmark(name, clusters, pruner=None, similarity=None,
+              unpruned=None, timing_repeats=1):
+    """
+    Times one system on a list of clusters. Each cluster is summarized
+    timing_repeats times and its latency is the fastest run, which is
+    less sensitive to noise from other processes. Returns latency
+    percentiles,
+    mean stage times (in seconds), the peak memory (in MB) traced while
+    summarizing the largest cluster, the mean ROUGE-1/2 F-scores of
+    the summaries, computed with rouge.py, and the summaries. If the
+    summaries of the same system without pruning are given as unpruned,
+    the share of summaries that differ from them is returned as well.
+    """
+    constructor = SYSTEMS[name]
+    oracle = name in ORACLES
+
+    def make_system():
+        if oracle:
+            return constructor()
+        if similarity is not None:
+            return constructor(pruner=pruner, similarity=similarity)
+        return constructor(pruner=pruner)
+
+    system = make_system()
+    profiler = attach_profiler(system)
+    # warm-up, loads the sentence splitter and other lazy resources
+    run_system(system, clusters[0], oracle)
+    profiler.drain()
+
+    latencies = []
+    rouge_scores = []
+    summaries = []
+    for c in clusters:
+        times = []
+        for _ in range(timing_repeats):
+            np.random.seed(0)
+            t1 = time.perf_counter()
+            summary = run_system(system, c, oracle)
+            times.append(time.perf_counter() - t1)
+        latencies.append(min(times))
+        summaries.append(summary)
+        r1, r2, _ = rouge.score_pair(c['summary'], summary)
+        rouge_scores.append((r1.fscore, r2.fscore))
+
+    largest = max(clusters, key=lambda c: len(c['articles']))
+    tracemalloc.start()
+    run_system(make_system(), largest, oracle)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    result = {
+        'p50': p50,
+        'p90': p90,
+        'p99': p99,
+        'mean': float(np.mean(latencies)),
+        'stages': dict(
+            (stage, s['total'] / (len(clusters) * timing_repeats))
+            for stage, s in profiler.summary().items()),
+        'timing_repeats': timing_repeats,
+        'peak_mb': peak / 2 ** 20,
+        'rouge-1': float(np.mean([x[0] for x in rouge_scores])),
+        'rouge-2': float(np.mean([x[1] for x in rouge_scores])),
+    }
+    if unpruned is not None:
+        result['changed'] = float(np.mean(
+            [a != b for a, b in zip(summaries, unpruned)]))
+    return result, summaries
+
+
+def compare(results, baseline, tolerance, mem_tolerance, min_diff):
+    """
+    Returns (key, description) of every result that is slower (median
+    latency) or needs more memory than the baseline by more than the
+    tolerances. Latencies are only comparable with the same number of
+    timing repeats.
+    """
+    regressions = []
+    for key, r in results.items():
+        if key not in baseline:
+            continue
+        b = baseline[key]
+        if r['timing_repeats'] != b.get('timing_repeats', 1):
+            regressions.append((key, (
+                f"{key}: baseline used {b.get('timing_repeats', 1)} timing "
+                f"repeats, this run {r['timing_repeats']}")))
+            continue
+        if r['p50'] > b['p50'] * (1 + tolerance) and \
+                r['p50'] - b['p50'] > min_diff:
+            regressions.append((
+                key, f"{key}: p50 {b['p50']:.4f}s -> {r['p50']:.4f}s"))
+        if r['peak_mb'] > b['peak_mb'] * (1 + mem_tolerance):
+            regressions.append((
+                key, f"{key}: peak memory {b['peak_mb']:.1f}MB -> "
+                     f"{r['peak_mb']:.1f}MB"))
+    return regressions
+
+
+def benchmark_sets(args):
+    """
+    Yields (name, clusters) of each set of clusters to benchmark on:
+    synthetic clusters of each size in args.sizes, or the first
+    args.repeats clusters of args.dataset that match args.where.
+    """
+    if args.dataset is not None:
+        clusters = read_clusters(
+            args.dataset, ClusterQuery.from_spec(args.where), 0, args.repeats)
+        yield 'data', list(clusters)
+        return
+    generator = SyntheticWCEP(seed=args.seed)
+    for n_articles in args.sizes:
+        yield str(n_articles), [
+            generator.cluster(n_articles, seed=args.seed + i)
+            for i in range(args.repeats)]
+
+
+def main(args):
+    results = {}
+    # arguments of benchmark for each key, to rerun suspected regressions
+    runs = {}
+    for set_name, clusters in benchmark_sets(args):
+        n_sents = max(sum(a['text'].count('.') for a in c['articles'])
+                      for c in clusters)
+        # unpruned runs first, pruned runs are compared with them
+        configs = sorted(
+            [(p, s) for p in args.prune for s in args.similarity],
+            key=lambda c: c[0] != 'none')
+        for name in args.systems:
+            unpruned = {}
+            for prune_spec, sim_spec in configs:
+                if name in ORACLES and prune_spec != 'none':
+                    continue
+                if name not in SIMILARITY_SYSTEMS and sim_spec != 'exact':
+                    continue
+                pruner = CandidatePruner.from_spec(prune_spec)
+                similarity = similarity_from_spec(sim_spec)
+                key = f'{name}@{set_name}'
+                for spec, default in ((prune_spec, 'none'),
+                                      (sim_spec, 'exact')):
+                    if spec != default:
+                        key += f'[{spec}]'
+                if name in DENSE_SYSTEMS and pruner is None and \
+                        similarity is None and \
+                        n_sents > args.max_dense_sents:
+                    print(f'{key}: skipped, ~{n_sents} sentences '
+                          f'> --max-dense-sents')
+                    continue
+                r, summaries = benchmark(name, clusters, pruner, similarity,
+                                         unpruned.get(sim_spec),
+                                         args.timing_repeats)
+                if pruner is None:
+                    unpruned[sim_spec] = summaries
+                results[key] = r
+                runs[key] = (name, clusters, pruner, similarity)
+                stages = ' '.join(f'{s}={t:.4f}'
+                                  for s, t in r['stages'].items())
+                changed = ''
+                if 'changed' in r:
+                    changed = f"changed={100 * r['changed']:.0f}% "
+                print(f"{key}: p50={r['p50']:.4f}s p90={r['p90']:.4f}s "
+                      f"p99={r['p99']:.4f}s peak={r['peak_mb']:.1f}MB "
+                      f"R1={r['rouge-1']:.4f} R2={r['rouge-2']:.4f} "
+                      f"{changed}| {stages}")
+
+    if args.o is not None:
+        utils.write_json(results, args.o)
+    if args.baseline is not None:
+        baseline = utils.read_json(args.baseline)
+        regressions = compare(results, baseline, args.tolerance,
+                              args.mem_tolerance, args.min_diff)
+        # a regression only counts if every retry shows it again, which
+        # filters out slowdowns caused by other load on the machine
+        for _ in range(args.retries):
+            if not regressions:
+                break
+            retried = {}
+            for key in sorted(set(key for key, _ in regressions)):
+                print('retrying', key)
+                retried[key], _ = benchmark(
+                    *runs[key], timing_repeats=args.timing_repeats)
+            regressions = compare(retried, baseline, args.tolerance,
+                                  args.mem_tolerance, args.min_diff)
+        for _, description in regressions:
+            print('REGRESSION', description)
+        if regressions:
+            raise SystemExit(f'{len(regressions)} regressions against '
+                             f'{args.baseline}')
+        print('no regressions against', args.baseline)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--systems', nargs='+', default=list(SYSTEMS),
+                        choices=list(SYSTEMS))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--repeats', type=int, default=5)
+    # runs per cluster, of which the fastest is its latency
+    parser.add_argument('--timing-repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    # real clusters instead of synthetic ones, e.g. to measure quality
+    parser.add_argument('--dataset')
+    # metadata conditions for --dataset clusters, see baselines.py
+    parser.add_argument('--where', default='none')
+    # candidate pruning settings to compare, see candidates.CandidatePruner
+    parser.add_argument('--prune', nargs='+', default=['none'])
+    # similarity backends to compare for textrank and submodular, e.g.
+    # exact blockwise,top_k=50 simhash,bands=16,rows=8
+    parser.add_argument('--similarity', nargs='+', default=['exact'])
+    # dense n x n float64 matrices need 8 * n^2 bytes
+    parser.add_argument('--max-dense-sents', type=int, default=6000)
+    parser.add_argument('--o')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--mem-tolerance', type=float, default=0.2)
+    parser.add_argument('--min-diff', type=float, default=0.005)
+    # reruns of configurations that regressed before failing
+    parser.add_argument('--retries', type=int, default=2)
+    main(parser.parse_args())
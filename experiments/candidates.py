@@ -0,0 +1,80 @@
+import numpy as np
+from vocab import get_vocab
+
+
+def lexical_scores(sents):
+    """
+    Cheap SumBasic-style salience: the mean frequency, within the given
+    sentences, of each sentence's content words. Sentences without content
+    words score 0.
+    """
+    mask = get_vocab().content_mask()
+    content_ids = [s.ids[mask[s.ids]] for s in sents]
+    lens = np.array([len(ids) for ids in content_ids])
+    if lens.sum() == 0:
+        return np.zeros(len(sents))
+    _, inverse, counts = np.unique(
+        np.concatenate(content_ids), return_inverse=True, return_counts=True)
+    sent_idx = np.repeat(np.arange(len(sents)), lens)
+    totals = np.bincount(
+        sent_idx, weights=counts[inverse], minlength=len(sents))
+    return totals / np.maximum(lens, 1)
+
+
+class CandidatePruner:
+    """
+    Reduces the candidate sentences of a cluster before a summarizer
+    computes similarities over them:
+    1) if filter_lengths is set, sentences that selection would reject
+       are removed: those outside [min_sent_tokens, max_sent_tokens] and
+       titles unless out_titles,
+    2) if max_per_article is set, only the first max_per_article sentences
+       of each article are kept,
+    3) if top_n is set, only the top_n sentences by lexical_scores are
+       kept.
+    The remaining sentences keep their order. Every step can change the
+    summaries: step 1 only removes sentences that cannot be selected, but
+    they no longer count towards IDF weights, the TextRank graph, the
+    centroid or submodular coverage, and steps 2 and 3 also change which
+    sentences can be selected. benchmark.py --prune reports the effect of
+    each on summary quality and speed.
+    """
+    def __init__(self, filter_lengths=True, max_per_article=None,
+                 top_n=None):
+        self.filter_lengths = filter_lengths
+        self.max_per_article = max_per_article
+        self.top_n = top_n
+
+    def prune(self, sents, out_titles, min_sent_tokens, max_sent_tokens):
+        if self.filter_lengths:
+            sents = [s for s in sents
+                     if min_sent_tokens <= len(s) <= max_sent_tokens
+                     and (out_titles or not s.is_title)]
+        if self.max_per_article is not None:
+            sents = [s for s in sents if s.position < self.max_per_article]
+        if self.top_n is not None and len(sents) > self.top_n:
+            scores = lexical_scores(sents)
+            keep = np.argsort(-scores, kind='stable')[:self.top_n]
+            sents = [sents[i] for i in sorted(keep.tolist())]
+        return sents
+
+    @staticmethod
+    def from_spec(spec):
+        """
+        Parses a pruner from a command line string such as
+        'lengths,per_article=10,top_n=200'. 'none' gives None.
+        """
+        if spec == 'none':
+            return None
+        kwargs = {'filter_lengths': False}
+        for part in spec.split(','):
+            key, _, value = part.partition('=')
+            if key == 'lengths':
+                kwargs['filter_lengths'] = True
+            elif key == 'per_article':
+                kwargs['max_per_article'] = int(value)
+            elif key == 'top_n':
+                kwargs['top_n'] = int(value)
+            else:
+                raise ValueError('Unknown pruning option: ' + key)
+        return CandidatePruner(**kwargs)
@@ -1,6 +1,5 @@
-import string
-from spacy.lang.en import STOP_WORDS
-STOP_WORDS |= set(string.punctuation)
+import numpy as np
+from vocab import get_vocab
 
 
 class Article:
@@ -18,10 +17,146 @@ class Article:
 class Sentence:
     def __init__(self, text, words, position, is_title=False):
         self.text = text
+        vocab = get_vocab()
         self.words = words
+        self.ids = vocab.encode(words)
         self.position = position
-        self.content_words = [w for w in words if w not in STOP_WORDS]
+        content = vocab.content_mask()[self.ids].tolist()
+        self.content_words = [w for w, c in zip(words, content) if c]
         self.is_title = is_title
 
     def __len__(self):
-        return len(self.words)
\ No newline at end of file
+        return len(self.words)
+
+
+class CompactCluster:
+    """
+    Array-backed alternative to lists of Article/Sentence objects. All
+    tokens of a cluster are stored as ids of the shared vocabulary (see
+    vocab.get_vocab) in one flat array, with sentence boundaries given by
+    offsets. Each article is stored as its title followed by its body
+    sentences. Use articles() to get Article-like views that existing
+    summarizers can consume.
+    """
+    __slots__ = ('vocab', 'token_ids', 'sent_offsets', 'texts', 'positions',
+                 'title_flags', 'article_offsets')
+
+    def __init__(self):
+        self.vocab = get_vocab()
+        self.token_ids = []
+        self.sent_offsets = [0]
+        self.texts = []
+        self.positions = []
+        self.title_flags = []
+        self.article_offsets = [0]
+
+    def add_sent(self, text, words, position, is_title):
+        self.token_ids.append(self.vocab.encode(words))
+        self.sent_offsets.append(self.sent_offsets[-1] + len(words))
+        self.texts.append(text)
+        self.positions.append(position)
+        self.title_flags.append(is_title)
+
+    def add_article(self, title, title_words, sents, sents_words):
+        self.add_sent(title, title_words, -1, True)
+        for position, (s, words) in enumerate(zip(sents, sents_words)):
+            self.add_sent(s, words, position, False)
+        self.article_offsets.append(len(self.texts))
+
+    def finalize(self):
+        """
+        Converts the build buffers into compact NumPy arrays.
+        """
+        self.token_ids = np.concatenate(
+            self.token_ids + [np.zeros(0, dtype=np.int32)])
+        self.sent_offsets = np.array(self.sent_offsets, dtype=np.int64)
+        self.positions = np.array(self.positions, dtype=np.int32)
+        self.title_flags = np.array(self.title_flags, dtype=bool)
+        self.article_offsets = np.array(self.article_offsets, dtype=np.int64)
+        return self
+
+    def content_mask(self):
+        """
+        Boolean mask over the vocabulary, True for content words, see
+        vocab.Vocabulary.content_mask.
+        """
+        return self.vocab.content_mask()
+
+    def sent_ids(self, i):
+        return self.token_ids[self.sent_offsets[i]:self.sent_offsets[i + 1]]
+
+    def sent_words(self, i):
+        return self.vocab.decode(self.sent_ids(i))
+
+    def articles(self):
+        return [ArticleView(self, i)
+                for i in range(len(self.article_offsets) - 1)]
+
+
+class ArticleView:
+    """
+    Article-compatible view of an article in a CompactCluster.
+    """
+    __slots__ = ('cluster', 'idx')
+
+    def __init__(self, cluster, idx):
+        self.cluster = cluster
+        self.idx = idx
+
+    @property
+    def title(self):
+        offsets = self.cluster.article_offsets
+        return SentenceView(self.cluster, offsets[self.idx])
+
+    @property
+    def sents(self):
+        offsets = self.cluster.article_offsets
+        return [SentenceView(self.cluster, i)
+                for i in range(offsets[self.idx] + 1, offsets[self.idx + 1])]
+
+    def words(self):
+        c = self.cluster
+        start = c.sent_offsets[c.article_offsets[self.idx]]
+        end = c.sent_offsets[c.article_offsets[self.idx + 1]]
+        return c.vocab.decode(c.token_ids[start:end])
+
+
+class SentenceView:
+    """
+    Sentence-compatible view of a sentence in a CompactCluster.
+    """
+    __slots__ = ('cluster', 'idx')
+
+    def __init__(self, cluster, idx):
+        self.cluster = cluster
+        self.idx = int(idx)
+
+    @property
+    def text(self):
+        return self.cluster.texts[self.idx]
+
+    @property
+    def ids(self):
+        return self.cluster.sent_ids(self.idx)
+
+    @property
+    def words(self):
+        return self.cluster.sent_words(self.idx)
+
+    @property
+    def content_words(self):
+        ids = self.ids
+        ids = ids[self.cluster.content_mask()[ids]]
+        return self.cluster.vocab.decode(ids)
+
+    @property
+    def position(self):
+        return int(self.cluster.positions[self.idx])
+
+    @property
+    def is_title(self):
+        return bool(self.cluster.title_flags[self.idx])
+
+    def __len__(self):
+        offsets = self.cluster.sent_offsets
+        return int(offsets[self.idx + 1] - offsets[self.idx])
@@ -0,0 +1,450 @@
+import os
+import json
+import gzip
+import zlib
+import struct
+import argparse
+import itertools
+import collections
+import utils
+
+
+MAGIC = b'WCEPIDX1'
+FOOTER = struct.Struct('<Q')
+# per-cluster metadata kept in the indexes for ClusterQuery
+META_FIELDS = ('date', 'category', 'collection', 'n_articles')
+
+
+def cluster_meta(cluster):
+    return {
+        'date': cluster.get('date'),
+        'category': cluster.get('category'),
+        'collection': cluster.get('collection'),
+        'n_articles': len(
+            cluster.get('articles', cluster.get('article_ids', []))),
+    }
+
+
+class IndexedDatasetWriter:
+    """
+    Writes clusters to an IndexedDataset file. Clusters are appended to
+    the current block as JSON lines, and a block is compressed and
+    written once it holds at least block_bytes of JSON.
+    """
+    def __init__(self, path, block_bytes=2 ** 20, level=6):
+        self.path = path
+        self.block_bytes = block_bytes
+        self.level = level
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC)
+        self.block = []
+        self.block_len = 0
+        self.block_offsets = [len(MAGIC)]
+        self.block_starts = [0]
+        self.line_offsets = []
+        self.ids = []
+        self.meta = {field: [] for field in META_FIELDS}
+
+    def add(self, cluster):
+        line = json.dumps(cluster).encode('utf-8') + b'\n'
+        self.line_offsets.append(self.block_len)
+        self.ids.append(cluster.get('id'))
+        for field, value in cluster_meta(cluster).items():
+            self.meta[field].append(value)
+        self.block.append(line)
+        self.block_len += len(line)
+        if self.block_len >= self.block_bytes:
+            self._flush()
+
+    def _flush(self):
+        if not self.block:
+            return
+        self.f.write(zlib.compress(b''.join(self.block), self.level))
+        self.block_offsets.append(self.f.tell())
+        self.block_starts.append(len(self.ids))
+        self.block = []
+        self.block_len = 0
+
+    def close(self):
+        self._flush()
+        index = {
+            'block_offsets': self.block_offsets,
+            'block_starts': self.block_starts,
+            'line_offsets': self.line_offsets,
+            'ids': self.ids,
+            'meta': self.meta,
+        }
+        index_offset = self.f.tell()
+        self.f.write(zlib.compress(json.dumps(index).encode('utf-8')))
+        self.f.write(FOOTER.pack(index_offset))
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class IndexedDataset:
+    """
+    Random access to the clusters of a dataset split without loading the
+    whole split. The file holds independently zlib-compressed blocks of
+    JSON lines, followed by an index of block offsets, the offset of each
+    cluster within its block, the cluster ids and the META_FIELDS of each
+    cluster (for ClusterQuery). dataset[i] and dataset.get(cluster_id)
+    decompress a single block and parse a single cluster; slices only
+    decompress the blocks they overlap. The most recently decompressed
+    block is kept, so sequential access decompresses each block once.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        self.f = open(self.path, 'rb')
+        if self.f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{self.path} is not an indexed dataset')
+        self.f.seek(-FOOTER.size, os.SEEK_END)
+        footer_offset = self.f.tell()
+        index_offset, = FOOTER.unpack(self.f.read(FOOTER.size))
+        self.f.seek(index_offset)
+        index = json.loads(zlib.decompress(
+            self.f.read(footer_offset - index_offset)))
+        self.block_offsets = index['block_offsets']
+        self.block_starts = index['block_starts']
+        self.line_offsets = index['line_offsets']
+        self.ids = index['ids']
+        self.meta = index['meta']
+        self.id_to_idx = {c_id: i for i, c_id in enumerate(self.ids)}
+        # block of each cluster
+        self.cluster_blocks = []
+        for b in range(len(self.block_starts) - 1):
+            self.cluster_blocks.extend(
+                [b] * (self.block_starts[b + 1] - self.block_starts[b]))
+        self._block_idx = None
+        self._block = None
+
+    def __getstate__(self):
+        # worker processes reopen the file
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._open()
+
+    def close(self):
+        self.f.close()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _read_block(self, b):
+        if b != self._block_idx:
+            start, end = self.block_offsets[b], self.block_offsets[b + 1]
+            self.f.seek(start)
+            self._block = zlib.decompress(self.f.read(end - start))
+            self._block_idx = b
+        return self._block
+
+    def _load(self, i):
+        b = self.cluster_blocks[i]
+        block = self._read_block(b)
+        start = self.line_offsets[i]
+        end = block.index(b'\n', start)
+        return json.loads(block[start:end])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._load(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('dataset index out of range')
+        return self._load(i)
+
+    def get(self, cluster_id, default=None):
+        i = self.id_to_idx.get(cluster_id)
+        if i is None:
+            return default
+        return self._load(i)
+
+    def __iter__(self):
+        return self.iter()
+
+    def iter(self, start=0, stop=None):
+        """
+        Yields the clusters from position start to stop.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        for i in range(start, stop):
+            yield self._load(i)
+
+
+class ArticleTable:
+    """
+    Reads single articles from the articles.jsonl.gz table of a dataset
+    written by combine_and_split.py --normalized, using the article
+    locations in articles.index.json. Only the gzip member holding an
+    article is decompressed, and the last max_members members are kept.
+    """
+    def __init__(self, path, index_path=None, max_members=8):
+        if index_path is None:
+            index_path = os.path.join(
+                os.path.dirname(path), 'articles.index.json')
+        index = utils.read_json(index_path)
+        self.path = path
+        self.member_offsets = index['member_offsets']
+        self.locations = index['articles']
+        self.max_members = max_members
+        self._members = collections.OrderedDict()
+        self.f = open(path, 'rb')
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, key):
+        return key in self.locations
+
+    def _read_member(self, m):
+        if m in self._members:
+            self._members.move_to_end(m)
+            return self._members[m]
+        start, end = self.member_offsets[m], self.member_offsets[m + 1]
+        self.f.seek(start)
+        member = gzip.decompress(self.f.read(end - start))
+        self._members[m] = member
+        if len(self._members) > self.max_members:
+            self._members.popitem(last=False)
+        return member
+
+    def __getitem__(self, key):
+        m, start = self.locations[key]
+        member = self._read_member(m)
+        return json.loads(member[start:member.index(b'\n', start)])
+
+    def join(self, cluster):
+        """
+        A copy of a normalized cluster with its articles filled in.
+        """
+        cluster = dict(cluster)
+        cluster['articles'] = [self[key] for key in cluster['article_ids']]
+        del cluster['article_ids']
+        return cluster
+
+    def close(self):
+        self.f.close()
+
+
+def article_table_path(path):
+    """
+    The article table belonging to a normalized split.
+    """
+    return os.path.join(os.path.dirname(path), 'articles.jsonl.gz')
+
+
+def is_indexed_dataset(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class ClusterQuery:
+    """
+    Filters clusters by their metadata. Dates are compared by prefix, so
+    date_from='2019', date_to='2019' selects all clusters of 2019.
+    categories and collections are sets of allowed values. All given
+    conditions must hold. Queries are evaluated against the metadata
+    columns of an index, so that only matching clusters are decoded.
+    """
+    def __init__(self, date_from=None, date_to=None, categories=None,
+                 collections=None, min_articles=None, max_articles=None):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.categories = None if categories is None else set(categories)
+        self.collections = None if collections is None else set(collections)
+        self.min_articles = min_articles
+        self.max_articles = max_articles
+
+    def matches(self, date, category, collection, n_articles):
+        if self.date_from is not None and \
+                (date is None or date[:len(self.date_from)] < self.date_from):
+            return False
+        if self.date_to is not None and \
+                (date is None or date[:len(self.date_to)] > self.date_to):
+            return False
+        if self.categories is not None and category not in self.categories:
+            return False
+        if self.collections is not None and \
+                collection not in self.collections:
+            return False
+        if self.min_articles is not None and n_articles < self.min_articles:
+            return False
+        if self.max_articles is not None and n_articles > self.max_articles:
+            return False
+        return True
+
+    def select(self, meta):
+        """
+        Positions of the matching clusters, given metadata columns.
+        """
+        rows = zip(*(meta[field] for field in META_FIELDS))
+        return [i for i, row in enumerate(rows) if self.matches(*row)]
+
+    @staticmethod
+    def from_spec(spec):
+        """
+        Parses a query from a command line string such as
+        'date_from=2019,category=Armed conflicts and attacks,min_articles=20'.
+        Alternative categories or collections are separated by '|'.
+        'none' gives None.
+        """
+        if spec is None or spec == 'none':
+            return None
+        kwargs = {}
+        for part in spec.split(','):
+            key, _, value = part.partition('=')
+            if key in ('date_from', 'date_to'):
+                kwargs[key] = value
+            elif key == 'category':
+                kwargs['categories'] = value.split('|')
+            elif key == 'collection':
+                kwargs['collections'] = value.split('|')
+            elif key in ('min_articles', 'max_articles'):
+                kwargs[key] = int(value)
+            else:
+                raise ValueError('Unknown query option: ' + key)
+        return ClusterQuery(**kwargs)
+
+
+def _open_lines(path):
+    if str(path).endswith('.gz'):
+        return gzip.open(path)
+    return open(path, 'rb')
+
+
+def meta_index(path):
+    """
+    Side index of a .jsonl or .jsonl.gz split: the META_FIELDS of each
+    cluster and, for uncompressed files, the byte offset of each line.
+    It is built with one pass over the split and stored next to it as
+    <path>.meta, and rebuilt when the split changes.
+    """
+    index_path = str(path) + '.meta'
+    stat = os.stat(path)
+    source = [stat.st_size, stat.st_mtime_ns]
+    if os.path.exists(index_path):
+        index = utils.read_json(index_path)
+        if index['source'] == source:
+            return index
+    meta = {field: [] for field in META_FIELDS}
+    offsets = []
+    offset = 0
+    with _open_lines(path) as f:
+        for line in f:
+            offsets.append(offset)
+            offset += len(line)
+            for field, value in cluster_meta(json.loads(line)).items():
+                meta[field].append(value)
+    index = {
+        'source': source,
+        'meta': meta,
+        'offsets': None if str(path).endswith('.gz') else offsets,
+    }
+    try:
+        utils.write_json(index, index_path)
+    except OSError:
+        pass
+    return index
+
+
+def read_clusters(path, query=None, start=0, stop=None, jobs=1):
+    """
+    Yields the clusters of a .jsonl, .jsonl.gz or IndexedDataset split,
+    optionally only those matching a ClusterQuery. start and stop select
+    a range of the (matching) clusters. With a query, the metadata index
+    is filtered first and only matching clusters are parsed; in indexed
+    and uncompressed files, the others are not even read. Clusters of
+    normalized splits are joined with their article table as they are
+    yielded. Without a query, .jsonl and .jsonl.gz files are decoded in
+    `jobs` processes if jobs > 1; with a query or an indexed split, jobs
+    must be 1.
+    """
+    if jobs > 1 and (query is not None or is_indexed_dataset(path)):
+        raise ValueError('parallel decoding is only supported for .jsonl '
+                         'and .jsonl.gz files without a query')
+    clusters = _read_cluster_records(path, query, start, stop, jobs)
+    table = None
+    for c in clusters:
+        if 'article_ids' in c:
+            if table is None:
+                table = ArticleTable(article_table_path(path))
+            c = table.join(c)
+        yield c
+    if table is not None:
+        table.close()
+
+
+def _read_cluster_records(path, query, start, stop, jobs):
+    if is_indexed_dataset(path):
+        dataset = IndexedDataset(path)
+        if query is None:
+            positions = range(len(dataset))
+        else:
+            positions = query.select(dataset.meta)
+        for i in positions[start:stop]:
+            yield dataset[i]
+        dataset.close()
+        return
+    if query is None:
+        if jobs > 1:
+            clusters = utils.read_jsonl_parallel(path, jobs)
+        elif str(path).endswith('.gz'):
+            clusters = utils.read_jsonl_gz(path)
+        else:
+            clusters = utils.read_jsonl(path)
+        yield from itertools.islice(clusters, start, stop)
+        return
+    index = meta_index(path)
+    positions = query.select(index['meta'])[start:stop]
+    if index['offsets'] is not None:
+        with open(path, 'rb') as f:
+            for i in positions:
+                f.seek(index['offsets'][i])
+                yield json.loads(f.readline())
+        return
+    todo = iter(positions)
+    next_i = next(todo, None)
+    with _open_lines(path) as f:
+        for i, line in enumerate(f):
+            if next_i is None:
+                break
+            if i == next_i:
+                yield json.loads(line)
+                next_i = next(todo, None)
+
+
+def convert(in_path, out_path, block_bytes=2 ** 20):
+    """
+    Converts a .jsonl or .jsonl.gz split to an IndexedDataset file.
+    """
+    if str(in_path).endswith('.gz'):
+        clusters = utils.read_jsonl_gz(in_path)
+    else:
+        clusters = utils.read_jsonl(in_path)
+    with IndexedDatasetWriter(out_path, block_bytes) as writer:
+        for c in clusters:
+            writer.add(c)
+    return len(writer.ids)
+
+
+def main(args):
+    n = convert(args.i, args.o, args.block_kb * 1024)
+    print(f'{n} clusters, {os.path.getsize(args.o)} bytes')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--i', required=True)
+    parser.add_argument('--o', required=True)
+    parser.add_argument('--block-kb', type=int, default=1024)
+    main(parser.parse_args())
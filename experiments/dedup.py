@@ -0,0 +1,146 @@
+import numpy as np
+from vocab import ngram_hashes
+from lsh import mix64, band_pairs
+
+
+def article_shingles(article, shingle_size):
+    """
+    Unique hashed word n-grams of the body of a preprocessed article, or of
+    its title if it has no body. Articles shorter than shingle_size words
+    are represented by a single shingle of all their words.
+    """
+    sents = article.sents if len(article.sents) > 0 else [article.title]
+    ids = np.concatenate(
+        [np.asarray(s.ids, dtype=np.int64) for s in sents] +
+        [np.zeros(0, dtype=np.int64)])
+    if len(ids) == 0:
+        return ids
+    return np.unique(ngram_hashes(ids, min(shingle_size, len(ids))))
+
+
+def _find(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+class ArticleDeduplicator:
+    """
+    Collapses near-duplicate articles of a cluster, e.g. syndicated copies
+    of the same wire story that only differ by a byline or boilerplate.
+    Articles are compared by the Jaccard similarity of their word
+    shingles: candidate pairs come from LSH banding over MinHash
+    signatures and are kept if their exact Jaccard similarity is
+    >= threshold. Groups of near-duplicates (connected components) are
+    reduced to their longest article, the others are removed.
+    Removed articles and sentences are counted in self.stats.
+    """
+    def __init__(self, threshold=0.8, shingle_size=5, n_hashes=128,
+                 n_bands=32, seed=0):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.n_hashes = n_hashes
+        self.n_bands = n_bands
+        self.seed = seed
+        self.stats = self._empty_stats()
+
+    @staticmethod
+    def _empty_stats():
+        return {'clusters': 0, 'articles': 0, 'removed_articles': 0,
+                'sents': 0, 'removed_sents': 0}
+
+    def duplicate_groups(self, articles):
+        """
+        Lists of indices of near-duplicate articles, one list per group of
+        at least 2 articles.
+        """
+        shingles = [article_shingles(a, self.shingle_size)
+                    for a in articles]
+        nonempty = [i for i, s in enumerate(shingles) if len(s) > 0]
+        if len(nonempty) < 2:
+            return []
+        seeds = mix64(np.arange(self.n_hashes, dtype=np.uint64) +
+                      np.uint64(self.seed))
+        signatures = np.vstack([
+            mix64(shingles[i].view(np.uint64)[:, None] ^ seeds).min(0)
+            for i in nonempty
+        ])
+        # buckets are never split, identical articles must all meet
+        I, J = band_pairs(signatures, self.n_bands,
+                          max_bucket=len(nonempty) + 1)
+        parents = list(range(len(articles)))
+        for i, j in zip(I.tolist(), J.tolist()):
+            a, b = shingles[nonempty[i]], shingles[nonempty[j]]
+            overlap = len(np.intersect1d(a, b, assume_unique=True))
+            jaccard = overlap / (len(a) + len(b) - overlap)
+            if jaccard >= self.threshold:
+                parents[_find(parents, nonempty[i])] = \
+                    _find(parents, nonempty[j])
+        groups = {}
+        for i in range(len(articles)):
+            groups.setdefault(_find(parents, i), []).append(i)
+        return [g for g in groups.values() if len(g) > 1]
+
+    def deduplicate(self, articles):
+        """
+        Returns the articles without near-duplicates, in their order.
+        """
+        removed = set()
+        for group in self.duplicate_groups(articles):
+            keep = max(group, key=lambda i: (len(articles[i].sents), -i))
+            removed.update(i for i in group if i != keep)
+        self.stats['clusters'] += 1
+        self.stats['articles'] += len(articles)
+        self.stats['removed_articles'] += len(removed)
+        for i, a in enumerate(articles):
+            self.stats['sents'] += len(a.sents)
+            if i in removed:
+                self.stats['removed_sents'] += len(a.sents)
+        return [a for i, a in enumerate(articles) if i not in removed]
+
+    def drain_stats(self):
+        """
+        Returns and resets the counts, e.g. to send them from a worker
+        process to the main process.
+        """
+        stats = self.stats
+        self.stats = self._empty_stats()
+        return stats
+
+    @staticmethod
+    def from_spec(spec):
+        """
+        Parses a deduplicator from a command line string such as
+        'threshold=0.8,shingle=5,hashes=128,bands=32'. 'default' gives the
+        default settings and 'none' gives None.
+        """
+        if spec == 'none':
+            return None
+        kwargs = {}
+        for part in spec.split(','):
+            key, _, value = part.partition('=')
+            if key == 'threshold':
+                kwargs['threshold'] = float(value)
+            elif key == 'shingle':
+                kwargs['shingle_size'] = int(value)
+            elif key == 'hashes':
+                kwargs['n_hashes'] = int(value)
+            elif key == 'bands':
+                kwargs['n_bands'] = int(value)
+            elif key == 'default':
+                pass
+            else:
+                raise ValueError('Unknown dedup option: ' + key)
+        return ArticleDeduplicator(**kwargs)
+
+
+def format_stats(stats):
+    articles = max(stats['articles'], 1)
+    sents = max(stats['sents'], 1)
+    return (f"near-duplicates: removed {stats['removed_articles']} of "
+            f"{stats['articles']} articles "
+            f"({100 * stats['removed_articles'] / articles:.1f}%), "
+            f"{stats['removed_sents']} of {stats['sents']} sentences "
+            f"({100 * stats['removed_sents'] / sents:.1f}%) "
+            f"in {stats['clusters']} clusters")
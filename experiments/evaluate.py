@@ -1,8 +1,12 @@
+import os
 import argparse
+import hashlib
+import itertools
 import collections
 import numpy as np
 import utils
-from newsroom.analyze.rouge import ROUGE_L, ROUGE_N
+import rouge
+from dataset import read_clusters, ClusterQuery
 
 
 def print_mean(results, rouge_types):
@@ -16,12 +20,26 @@ def print_mean(results, rouge_types):
         print(rouge_type, 'p:', p, 'r:', r, 'f:', f)
 
 
-def evaluate(ref_summaries, pred_summaries, lowercase=False):
+ROUGE_TYPES = ['rouge-1', 'rouge-2', 'rouge-l']
+SCORE_COLUMNS = [f'{t}-{m}' for t in ROUGE_TYPES for m in 'prf']
 
-    rouge_types = ['rouge-1', 'rouge-2', 'rouge-l']
-    results = dict((rouge_type, collections.defaultdict(list))
-                   for rouge_type in rouge_types)
 
+def score_summaries(ref_summaries, pred_summaries, lowercase=False,
+                    engine='newsroom', jobs=1):
+    """
+    Returns (rouge-1, rouge-2, rouge-l) scores for each pair, computed with
+    newsroom's ROUGE or with the faster, batched implementation in rouge.py
+    (engine='fast'). The fast engine is not yet verified against newsroom,
+    see rouge.check_parity.
+    """
+    if engine == 'fast':
+        return rouge.score_pairs(
+            ref_summaries, pred_summaries, lowercase=lowercase, jobs=jobs)
+    elif engine != 'newsroom':
+        raise ValueError('engine must be in (newsroom|fast)')
+
+    from newsroom.analyze.rouge import ROUGE_L, ROUGE_N
+    scores = []
     for ref, pred in zip(ref_summaries, pred_summaries):
 
         if lowercase:
@@ -31,7 +49,20 @@ def evaluate(ref_summaries, pred_summaries, lowercase=False):
         r1 = ROUGE_N(ref, pred, n=1)
         r2 = ROUGE_N(ref, pred, n=2)
         rl = ROUGE_L(ref, pred)
+        scores.append((r1, r2, rl))
+    return scores
+
+
+def evaluate(ref_summaries, pred_summaries, lowercase=False,
+             engine='newsroom', jobs=1):
+
+    rouge_types = ROUGE_TYPES
+    results = dict((rouge_type, collections.defaultdict(list))
+                   for rouge_type in rouge_types)
 
+    all_scores = score_summaries(
+        ref_summaries, pred_summaries, lowercase, engine, jobs)
+    for r1, r2, rl in all_scores:
         for (rouge_type, scores) in zip(rouge_types, [r1, r2, rl]):
             results[rouge_type]['p'].append(scores.precision)
             results[rouge_type]['r'].append(scores.recall)
@@ -51,15 +82,18 @@ def evaluate(ref_summaries, pred_summaries, lowercase=False):
     return mean_results
 
 
-def evaluate_from_path(dataset_path, pred_path, start, stop, lowercase=False):
+def evaluate_from_path(dataset_path, pred_path, start, stop, lowercase=False,
+                       engine='newsroom', jobs=1, query=None):
 
-    dataset = utils.read_jsonl(dataset_path)
+    dataset = read_clusters(dataset_path, query)
     predictions = utils.read_jsonl(pred_path)
 
-    rouge_types = ['rouge-1', 'rouge-2', 'rouge-l']
+    rouge_types = ROUGE_TYPES
     results = dict((rouge_type, collections.defaultdict(list))
                    for rouge_type in rouge_types)
 
+    refs = []
+    hyps = []
     for i, cluster in enumerate(dataset):
         if start > -1 and i < start:
             continue
@@ -69,43 +103,182 @@ def evaluate_from_path(dataset_path, pred_path, start, stop, lowercase=False):
         prediction = next(predictions)
         assert prediction['cluster_id'] == cluster['id']
 
-        hyp = prediction['summary']
-        ref = cluster['summary']
-
-        if lowercase:
-            hyp = hyp.lower()
-            ref = ref.lower()
-
-        r1 = ROUGE_N(ref, hyp, n=1)
-        r2 = ROUGE_N(ref, hyp, n=2)
-        rl = ROUGE_L(ref, hyp)
+        hyps.append(prediction['summary'])
+        refs.append(cluster['summary'])
 
+    all_scores = score_summaries(refs, hyps, lowercase, engine, jobs)
+    for r1, r2, rl in all_scores:
         for (rouge_type, scores) in zip(rouge_types, [r1, r2, rl]):
             results[rouge_type]['p'].append(scores.precision)
             results[rouge_type]['r'].append(scores.recall)
             results[rouge_type]['f'].append(scores.fscore)
 
-        if i % 100 == 0:
-            print(i)
-            # print_mean(results, rouge_types)
-
     print('Final Average:')
     print_mean(results, rouge_types)
     return results
 
 
+def pair_hash(ref, hyp, lowercase, engine):
+    h = hashlib.blake2b(digest_size=8)
+    for x in (ref, hyp, str(lowercase), engine):
+        x = x.encode('utf-8', 'surrogatepass')
+        h.update(str(len(x)).encode() + b':' + x)
+    return np.frombuffer(h.digest(), dtype=np.uint64)[0]
+
+
+def load_scores(path):
+    """
+    Reads a per-cluster score store written by score_shard: a dict of
+    columns 'cluster_id', 'position', 'hash' and one column per
+    SCORE_COLUMNS entry.
+    """
+    with np.load(path, allow_pickle=False) as f:
+        return dict((k, f[k]) for k in f.files)
+
+
+def score_shard(dataset_path, pred_path, out_path, shard=0, n_shards=1,
+                lowercase=False, engine='newsroom', jobs=1, index_dir=None,
+                query=None, start=-1, stop=-1):
+    """
+    Scores the clusters at positions i with i % n_shards == shard and
+    writes their scores to out_path, a columnar .npz score store. As in
+    evaluate_from_path, start and stop select a range of clusters, the
+    predictions cover that range and positions count from start. If
+    out_path already exists, only clusters whose reference or prediction
+    changed are rescored. If index_dir is given, references are read from
+    a reference_index.ReferenceIndex instead of the dataset; lowercase
+    must then match the index, and queries are not supported.
+    """
+    old = {}
+    if os.path.exists(out_path):
+        stored = load_scores(out_path)
+        for i, (c, h) in enumerate(zip(stored['cluster_id'], stored['hash'])):
+            old[c] = (h, [stored[col][i] for col in SCORE_COLUMNS])
+
+    if index_dir is not None:
+        from reference_index import ReferenceIndex
+        index = ReferenceIndex(index_dir)
+        if lowercase != index.lowercase:
+            raise ValueError(
+                f'reference index was built with lowercase={index.lowercase}')
+        if query is not None:
+            raise ValueError(
+                'queries are not supported with a reference index')
+        clusters = ({'id': c} for c in index.cluster_ids)
+    else:
+        index = None
+        clusters = read_clusters(dataset_path, query)
+    clusters = itertools.islice(
+        clusters, max(start, 0), None if stop < 0 else stop)
+    predictions = utils.read_jsonl(pred_path)
+
+    cluster_ids, positions, hashes, rows = [], [], [], []
+    todo = []
+    pairs = itertools.zip_longest(clusters, predictions)
+    for i, (cluster, prediction) in enumerate(pairs):
+        assert cluster is not None and prediction is not None, \
+            'numbers of predictions and clusters differ'
+        if i % n_shards != shard:
+            continue
+        assert prediction['cluster_id'] == cluster['id']
+        ref = cluster.get('summary', '')
+        hyp = prediction['summary']
+        h = pair_hash(ref, hyp, lowercase, 'index' if index else engine)
+        cluster_ids.append(cluster['id'])
+        positions.append(i)
+        hashes.append(h)
+        if cluster['id'] in old and old[cluster['id']][0] == h:
+            rows.append(old[cluster['id']][1])
+        else:
+            rows.append(None)
+            todo.append((len(rows) - 1, cluster['id'], ref, hyp))
+
+    if index is not None:
+        new_scores = [index.score(c, hyp) for _, c, _, hyp in todo]
+    else:
+        new_scores = score_summaries(
+            [x[2] for x in todo], [x[3] for x in todo], lowercase, engine,
+            jobs)
+    for (row, _, _, _), scores in zip(todo, new_scores):
+        rows[row] = [v for s in scores
+                     for v in (s.precision, s.recall, s.fscore)]
+    print(f'shard {shard}/{n_shards}: {len(rows)} clusters, '
+          f'{len(todo)} rescored')
+
+    columns = np.array(rows, dtype=np.float64).reshape(-1, len(SCORE_COLUMNS))
+    store = {
+        'cluster_id': np.array(cluster_ids, dtype=str),
+        'position': np.array(positions, dtype=np.int64),
+        'hash': np.array(hashes, dtype=np.uint64)
+    }
+    for j, col in enumerate(SCORE_COLUMNS):
+        store[col] = columns[:, j]
+    tmp_path = str(out_path) + '.tmp.npz'
+    np.savez(tmp_path, **store)
+    os.replace(tmp_path, out_path)
+
+
+def merge_scores(paths):
+    """
+    Combines the score stores of all shards into per-cluster result lists
+    in dataset order, in the format returned by evaluate_from_path.
+    """
+    stores = [load_scores(path) for path in paths]
+    cluster_ids = np.concatenate([s['cluster_id'] for s in stores])
+    assert len(set(cluster_ids.tolist())) == len(cluster_ids), \
+        'shards overlap'
+    positions = np.concatenate([s['position'] for s in stores])
+    order = np.argsort(positions, kind='stable')
+    assert np.array_equal(positions[order], np.arange(len(positions))), \
+        'shards are missing'
+    results = {}
+    for rouge_type in ROUGE_TYPES:
+        results[rouge_type] = {}
+        for m in 'prf':
+            col = f'{rouge_type}-{m}'
+            results[rouge_type][m] = np.concatenate(
+                [s[col] for s in stores])[order].tolist()
+    return results
+
+
 def main(args):
-    results = evaluate(args.dataset, args.preds, args.start, args.stop,
-                       args.lowercase)
-    utils.write_json(results, args.o)
+    query = ClusterQuery.from_spec(args.where)
+    if args.mode == 'evaluate':
+        results = evaluate_from_path(
+            args.dataset, args.preds, args.start, args.stop, args.lowercase,
+            args.engine, args.jobs, query)
+    elif args.mode == 'score':
+        score_shard(
+            args.dataset, args.preds, args.scores[0], args.shard,
+            args.n_shards, args.lowercase, args.engine, args.jobs, args.index,
+            query, args.start, args.stop)
+        return
+    elif args.mode == 'merge':
+        results = merge_scores(args.scores)
+        print(len(results['rouge-1']['f']), 'clusters')
+        print_mean(results, ROUGE_TYPES)
+    else:
+        raise ValueError('Unknown or unspecified --mode: ' + str(args.mode))
+    if args.o is not None:
+        utils.write_json(results, args.o)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', default='evaluate')
     parser.add_argument('--dataset')
     parser.add_argument('--preds')
     parser.add_argument('--o')
     parser.add_argument('--start', type=int, default=-1)
     parser.add_argument('--stop', type=int, default=-1)
     parser.add_argument('--lowercase', action='store_true')
+    parser.add_argument('--engine', default='newsroom')
+    parser.add_argument('--jobs', type=int, default=1)
+    # sharded scoring: score one shard into a score store, then merge
+    parser.add_argument('--shard', type=int, default=0)
+    parser.add_argument('--n-shards', type=int, default=1)
+    parser.add_argument('--scores', nargs='+')
+    parser.add_argument('--index')
+    # same metadata conditions as for the predictions, see baselines.py
+    parser.add_argument('--where', default='none')
     main(parser.parse_args())
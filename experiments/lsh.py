@@ -0,0 +1,180 @@
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+
+def mix64(x):
+    """
+    splitmix64 finalizer, a fast well-mixing hash of uint64 arrays.
+    """
+    x = np.array(x, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xbf58476d1ce4e5b9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94d049bb133111eb)
+        x ^= x >> np.uint64(31)
+    return x
+
+
+def minhash_signatures(X, n_hashes, seed=0, chunk_size=2048):
+    """
+    MinHash signatures (n_rows x n_hashes, uint64) of the sets of nonzero
+    columns of each row of a CSR matrix, i.e. of the content terms of each
+    sentence. Rows must be nonempty.
+    """
+    seeds = mix64(np.arange(n_hashes, dtype=np.uint64) + np.uint64(seed))
+    signatures = []
+    for start in range(0, X.shape[0], chunk_size):
+        block = X[start:start + chunk_size]
+        hashes = mix64(block.indices.astype(np.uint64)[:, None] ^ seeds)
+        signatures.append(
+            np.minimum.reduceat(hashes, block.indptr[:-1], axis=0))
+    return np.vstack(signatures)
+
+
+def simhash_signatures(X, n_bits, seed=0, chunk_size=2048):
+    """
+    SimHash (random hyperplane) signatures (n_rows x n_bits, 0/1) of the
+    rows of a CSR matrix. The hyperplanes have +-1 entries derived from a
+    hash of (column, bit), so they never need to be stored. Two rows agree
+    on each bit with probability 1 - angle / pi.
+    """
+    bits = np.arange(n_bits, dtype=np.uint64)
+    seed_mask = mix64(seed)
+    signatures = []
+    for start in range(0, X.shape[0], chunk_size):
+        block = X[start:start + chunk_size]
+        cols = block.indices.astype(np.uint64)[:, None]
+        h = mix64((cols * np.uint64(n_bits) + bits) ^ seed_mask)
+        signs = np.where(h >> np.uint64(63), 1., -1.)
+        projections = np.add.reduceat(
+            signs * block.data[:, None], block.indptr[:-1], axis=0)
+        signatures.append((projections > 0).astype(np.uint64))
+    return np.vstack(signatures)
+
+
+def band_pairs(signatures, n_bands, max_bucket=50):
+    """
+    LSH banding: rows whose signatures agree on all values of at least one
+    band become candidate pairs. Buckets with more than max_bucket rows
+    are split into chunks of max_bucket rows, which bounds the number of
+    pairs per bucket. Returns unique pairs (i, j) with i < j.
+    """
+    n, n_values = signatures.shape
+    rows_per_band = n_values // n_bands
+    bands = signatures[:, :n_bands * rows_per_band].reshape(
+        n, n_bands, rows_per_band)
+    # bucket keys of all bands at once, one column per band
+    band_keys = mix64(np.tile(np.arange(n_bands, dtype=np.uint64), (n, 1)))
+    for j in range(rows_per_band):
+        band_keys = mix64(band_keys ^ bands[:, :, j])
+    pair_keys = []
+    for b in range(n_bands):
+        keys = band_keys[:, b]
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        new_group = np.concatenate(
+            [[True], sorted_keys[1:] != sorted_keys[:-1]])
+        group_starts = np.flatnonzero(new_group)
+        group_ids = np.cumsum(new_group) - 1
+        # chunk of each row within its (split) bucket
+        positions = np.arange(n) - group_starts[group_ids]
+        chunks = group_ids * n + positions // max_bucket
+        for d in range(1, max_bucket):
+            same = chunks[d:] == chunks[:-d]
+            if not same.any():
+                break
+            i, j = order[:-d][same], order[d:][same]
+            pair_keys.append(np.minimum(i, j).astype(np.int64) * n +
+                             np.maximum(i, j))
+    if len(pair_keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pair_keys = np.unique(np.concatenate(pair_keys))
+    return pair_keys // n, pair_keys % n
+
+
+class LSHSimilarity:
+    """
+    Approximate sparse replacement for cosine_similarity(X). Candidate
+    neighbour pairs are found by LSH banding over MinHash signatures of
+    the content terms of each sentence (approximating Jaccard similarity)
+    or SimHash signatures of the TF-IDF vectors (approximating cosine),
+    and exact cosine similarities are computed for those pairs only, in
+    near-linear time for sparse clusters.
+
+    n_bands and rows_per_band trade recall for speed: a pair with
+    similarity s becomes a candidate with probability
+    1 - (1 - p(s) ** rows_per_band) ** n_bands, where p(s) is the Jaccard
+    similarity (minhash) or 1 - angle / pi (simhash). More bands or fewer
+    rows per band find more pairs. Like similarity.BlockwiseSimilarity,
+    pairwise also returns the exact row sums of the full matrix.
+    """
+    def __init__(self, method='simhash', n_bands=16, rows_per_band=8,
+                 threshold=None, max_bucket=50, seed=0):
+        if method not in ('minhash', 'simhash'):
+            raise ValueError('method must be in (minhash|simhash)')
+        self.method = method
+        self.n_bands = n_bands
+        self.rows_per_band = rows_per_band
+        self.threshold = threshold
+        self.max_bucket = max_bucket
+        self.seed = seed
+
+    def candidate_pairs(self, X):
+        nonempty = np.flatnonzero(np.diff(X.indptr) > 0)
+        if len(nonempty) < 2:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        n_values = self.n_bands * self.rows_per_band
+        if self.method == 'minhash':
+            signatures = minhash_signatures(X[nonempty], n_values, self.seed)
+        else:
+            signatures = simhash_signatures(X[nonempty], n_values, self.seed)
+        i, j = band_pairs(signatures, self.n_bands, self.max_bucket)
+        return nonempty[i], nonempty[j]
+
+    def pairwise(self, X, chunk_size=100000):
+        X = normalize(sparse.csr_matrix(X, dtype=np.float32))
+        n = X.shape[0]
+        I, J = self.candidate_pairs(X)
+        values = np.empty(len(I), dtype=np.float32)
+        for k in range(0, len(I), chunk_size):
+            rows_i = X[I[k:k + chunk_size]]
+            rows_j = X[J[k:k + chunk_size]]
+            values[k:k + chunk_size] = np.asarray(
+                rows_i.multiply(rows_j).sum(1)).ravel()
+        keep = values > 0
+        if self.threshold is not None:
+            keep &= values >= self.threshold
+        I, J, values = I[keep], J[keep], values[keep]
+        diag = np.flatnonzero(np.diff(X.indptr) > 0)
+        S = sparse.csr_matrix(
+            (np.concatenate([values, values, np.ones(len(diag),
+                                                     dtype=np.float32)]),
+             (np.concatenate([I, J, diag]), np.concatenate([J, I, diag]))),
+            shape=(n, n), dtype=np.float32
+        )
+        X64 = X.astype(np.float64)
+        sums = np.asarray(X64 @ X64.sum(0).T).ravel()
+        return S, sums
+
+    @staticmethod
+    def from_spec(spec):
+        """
+        Parses a command line string such as 'minhash,bands=20,rows=5'.
+        """
+        method, *options = spec.split(',')
+        kwargs = {}
+        for option in options:
+            key, _, value = option.partition('=')
+            if key == 'bands':
+                kwargs['n_bands'] = int(value)
+            elif key == 'rows':
+                kwargs['rows_per_band'] = int(value)
+            elif key == 'threshold':
+                kwargs['threshold'] = float(value)
+            elif key == 'max_bucket':
+                kwargs['max_bucket'] = int(value)
+            else:
+                raise ValueError('Unknown LSH option: ' + key)
+        return LSHSimilarity(method, **kwargs)
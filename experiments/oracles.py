@@ -1,7 +1,12 @@
 import argparse
+import numpy as np
 from collections import Counter
 from nltk import word_tokenize, ngrams
 from summarizer import Summarizer
+from vocab import get_vocab, ngram_hashes
+from profiling import Profiler
+from dedup import ArticleDeduplicator
+from dataset import ClusterQuery
 import utils
 
 
@@ -46,6 +51,106 @@ def compute_rouge_n(hyp, ref, rouge_n=1, tokenize=True):
     return {'p': precision, 'r': recall, 'f': fscore}
 
 
+def _prf(match, hyp_total, ref_total):
+    if hyp_total == 0 or ref_total == 0:
+        return {'p': 0., 'r': 0., 'f': 0.}
+    precision = 0 if match == 0 else match / hyp_total
+    recall = 0 if match == 0 else match / ref_total
+    if precision == 0 or recall == 0:
+        fscore = 0
+    else:
+        fscore = 2 * precision * recall / (precision + recall)
+    return {'p': precision, 'r': recall, 'f': fscore}
+
+
+class IncrementalRougeN:
+    """
+    ROUGE-N of a summary that is built by appending sentences, against a
+    fixed reference. Texts are given as token id arrays of the shared
+    vocabulary and n-grams are int64 keys (see vocab.ngram_hashes).
+    Reference n-gram counts are computed once, and each sentence is
+    reduced once to the counts of its n-grams that occur in the reference
+    (see prepare). Scoring a candidate sentence then only touches that
+    sentence's n-grams, plus the n - 1 n-grams that cross the boundary to
+    the current summary. Gives the same scores as compute_rouge_n on the
+    concatenated words.
+    """
+    def __init__(self, ref_ids, rouge_n=1):
+        self.n = rouge_n
+        self.ref_counts = Counter(self._ngrams(ref_ids))
+        self.ref_total = sum(self.ref_counts.values())
+        self.reset()
+
+    def _ngrams(self, ids):
+        return ngram_hashes(ids, self.n).tolist()
+
+    def reset(self):
+        self.hyp_counts = Counter()
+        self.hyp_total = 0
+        self.match = 0
+        self.tail = []
+
+    def prepare(self, ids):
+        """
+        Precomputes what is needed to score appending this sentence:
+        (first n-1 ids, counts of matching n-grams, number of n-grams,
+        last n-1 ids).
+        """
+        items = self._ngrams(ids)
+        ref_counts = self.ref_counts
+        counts = Counter(x for x in items if x in ref_counts)
+        k = self.n - 1
+        ids = np.asarray(ids).tolist()
+        return ids[:k], counts, len(items), ids[-k:] if k else []
+
+    def _delta(self, prepared):
+        head, counts, n_items, _ = prepared
+        if self.n > 1 and self.tail:
+            boundary = self._ngrams(self.tail + head)
+            if boundary:
+                counts = counts.copy()
+                for x in boundary:
+                    if x in self.ref_counts:
+                        counts[x] += 1
+                n_items += len(boundary)
+        match = self.match
+        for x, c in counts.items():
+            h = self.hyp_counts[x]
+            r = self.ref_counts[x]
+            match += min(h + c, r) - min(h, r)
+        return counts, n_items, match
+
+    def score(self, prepared):
+        """
+        Scores of the current summary with the prepared sentence appended.
+        """
+        _, n_items, match = self._delta(prepared)
+        return _prf(match, self.hyp_total + n_items, self.ref_total)
+
+    def add(self, prepared):
+        counts, n_items, match = self._delta(prepared)
+        self.hyp_counts.update(counts)
+        self.hyp_total += n_items
+        self.match = match
+        head, _, _, tail = prepared
+        k = self.n - 1
+        if k and len(head) < k:
+            # sentence shorter than n - 1, the old tail partly remains
+            self.tail = (self.tail + head)[-k:]
+        elif k:
+            self.tail = tail
+
+    def score_ids(self, ids):
+        """
+        Scores a complete summary given as token ids.
+        """
+        hyp_counts = Counter(self._ngrams(ids))
+        match = 0
+        for x, c in hyp_counts.items():
+            match += min(c, self.ref_counts[x])
+        return _prf(match, sum(hyp_counts.values()), self.ref_total)
+
+
 class Oracle():
     def __init__(self, rouge_n=1, metric='f', early_stopping=True):
         self.rouge_n = rouge_n
@@ -64,44 +169,51 @@ class Oracle():
                   max_sent_tokens=40):
 
         articles = self.summarizer._preprocess(articles)
+        with self.summarizer._stage('reference'):
+            engine = IncrementalRougeN(
+                get_vocab().encode(word_tokenize(ref)), self.rouge_n)
+        with self.summarizer._stage('greedy', n_articles=len(articles)):
+            return self.summarize_preprocessed(
+                engine, articles, max_len, len_type, in_titles, out_titles)
+
+    def summarize_preprocessed(self,
+                               engine,
+                               articles,
+                               max_len=40,
+                               len_type='words',
+                               in_titles=False,
+                               out_titles=False):
+        """
+        Greedy oracle selection from already preprocessed articles, scored
+        against the reference held by an IncrementalRougeN engine.
+        """
         sents = [s for a in articles for s in a.sents]
         sents = self.summarizer._deduplicate(sents)
         if in_titles == False or out_titles == False:
             sents = [s for s in sents if not s.is_title]
         sent_lens = [self.summarizer._sent_len(s, len_type) for s in sents]
+        prepared = [engine.prepare(s.ids) for s in sents]
+        engine.reset()
         current_len = 0
         remaining = list(range(len(sents)))
         selected = []
         scored_selections = []
-        ref_words = word_tokenize(ref)
 
         while current_len < max_len and len(remaining) > 0:
             scored = []
-            current_summary_words = [
-                tok for i in selected for tok in sents[i].words
-            ]
             for i in remaining:
                 new_len = current_len + sent_lens[i]
                 if new_len <= max_len:
-                    try:
-                        summary_words = current_summary_words + sents[i].words
-                        rouge_scores = compute_rouge_n(
-                            summary_words,
-                            ref_words,
-                            rouge_n=self.rouge_n,
-                            tokenize=False
-                        )
-                        score = rouge_scores[self.metric]
-                        scored.append((i, score))
-                    except:
-                        pass
+                    score = engine.score(prepared[i])[self.metric]
+                    scored.append((i, score))
             if len(scored) == 0:
                 break
             scored.sort(key=lambda x: x[1], reverse=True)
             best_idx, best_score = scored[0]
             scored_selections.append((selected + [best_idx], best_score))
             current_len += sent_lens[best_idx]
-            selected.append(scored[0][0])
+            selected.append(best_idx)
+            engine.add(prepared[best_idx])
             remaining.remove(best_idx)
 
         if self.early_stopping == False:
@@ -135,20 +247,21 @@ class SingleOracle():
                   min_sent_tokens=7,
                   max_sent_tokens=40):
 
+        summarizer = self.oracle.summarizer
+        articles = summarizer._preprocess(articles)
+        with summarizer._stage('reference'):
+            engine = IncrementalRougeN(
+                get_vocab().encode(word_tokenize(ref)), self.rouge_n)
         scored_oracles = []
-        for a in articles:
-            summary = self.oracle.summarize(
-                ref, [a], max_len, len_type, in_titles, out_titles,
-                min_sent_tokens, max_sent_tokens
-            )
-            rouge_scores = compute_rouge_n(
-                summary,
-                ref,
-                rouge_n=self.rouge_n,
-                tokenize=True
-            )
-            score = rouge_scores[self.metric]
-            scored_oracles.append((summary, score))
+        with summarizer._stage('greedy', n_articles=len(articles)):
+            for a in articles:
+                summary = self.oracle.summarize_preprocessed(
+                    engine, [a], max_len, len_type, in_titles, out_titles
+                )
+                rouge_scores = engine.score_ids(
+                    get_vocab().encode(word_tokenize(summary)))
+                score = rouge_scores[self.metric]
+                scored_oracles.append((summary, score))
         scored_oracles.sort(key=lambda x: x[1], reverse=True)
         return scored_oracles[0][0]
 
@@ -170,31 +283,31 @@ class LeadOracle():
                   max_sent_tokens=40):
 
         articles = self.summarizer._preprocess(articles)
+        with self.summarizer._stage('reference'):
+            engine = IncrementalRougeN(
+                get_vocab().encode(word_tokenize(ref)), self.rouge_n)
         scored_summaries = []
-        for a in articles:
-            selected_sents = []
-            current_len = 0
-            sents = a.sents
-            if in_titles == False or out_titles == False:
-                sents = [s for s in sents if not s.is_title]
-            for s in sents:
-                l = self.summarizer._sent_len(s, len_type)
-                new_len = current_len + l
-                if new_len <= max_len:
-                    selected_sents.append(s.text)
-                    current_len = new_len
-                if new_len > max_len:
-                    break
-            if len(selected_sents) >= 1:
-                summary = ' '.join(selected_sents)
-                rouge_scores = compute_rouge_n(
-                    summary,
-                    ref,
-                    self.rouge_n,
-                    tokenize=True
-                )
-                score = rouge_scores[self.metric]
-                scored_summaries.append((summary, score))
+        with self.summarizer._stage('lead', n_articles=len(articles)):
+            for a in articles:
+                selected_sents = []
+                current_len = 0
+                sents = a.sents
+                if in_titles == False or out_titles == False:
+                    sents = [s for s in sents if not s.is_title]
+                for s in sents:
+                    l = self.summarizer._sent_len(s, len_type)
+                    new_len = current_len + l
+                    if new_len <= max_len:
+                        selected_sents.append(s.text)
+                        current_len = new_len
+                    if new_len > max_len:
+                        break
+                if len(selected_sents) >= 1:
+                    summary = ' '.join(selected_sents)
+                    rouge_scores = engine.score_ids(
+                        get_vocab().encode(word_tokenize(summary)))
+                    score = rouge_scores[self.metric]
+                    scored_summaries.append((summary, score))
         scored_summaries.sort(key=lambda x: x[1], reverse=True)
         summary = scored_summaries[0][0]
         return summary
@@ -220,6 +333,9 @@ def main(args):
         raise ValueError('Unknown or unspecified --mode: ' + args.mode)
 
     summarize_settings = utils.args_to_summarize_settings(args)
+    profiler = None
+    if args.profile is not None or args.trace is not None:
+        profiler = Profiler()
     Summarizer.summarize_dataset(
         summarizer,
         dataset_path=args.dataset,
@@ -229,8 +345,23 @@ def main(args):
         stop=args.stop,
         batchsize=args.batchsize,
         jobs=args.jobs,
-        oracle=True
+        oracle=True,
+        override=args.override,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        compact=args.compact,
+        vocab_path=args.vocab,
+        profiler=profiler,
+        deduplicator=ArticleDeduplicator.from_spec(args.dedup),
+        query=ClusterQuery.from_spec(args.where),
+        read_jobs=args.read_jobs
     )
+    if profiler is not None:
+        profiler.print_summary()
+        if args.profile is not None:
+            profiler.to_json(args.profile)
+        if args.trace is not None:
+            profiler.to_chrome_trace(args.trace)
 
 
 if __name__ == '__main__':
@@ -251,5 +382,24 @@ if __name__ == '__main__':
     parser.add_argument('--metric', default='f')
     parser.add_argument('--batchsize', type=int, default=32)
     parser.add_argument('--jobs', type=int, default=4)
+    # processes decoding the dataset, for splits with very large clusters
+    parser.add_argument('--read-jobs', type=int, default=1)
     parser.add_argument('--early-stopping', action='store_true')
-    main(parser.parse_args())
+    parser.add_argument('--override', action='store_true')
+    parser.add_argument('--cache-dir')
+    # bytes of cached clusters per tokenizer setting in --cache-dir
+    parser.add_argument('--cache-size', type=int, default=2 ** 32)
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--vocab')
+    # collapse near-duplicate articles, e.g. threshold=0.8,shingle=5
+    parser.add_argument('--dedup', default='none')
+    # only clusters matching metadata conditions, e.g.
+    # date_from=2019,category=Armed conflicts and attacks,min_articles=20
+    parser.add_argument('--where', default='none')
+    # per-stage timings as JSON and/or Chrome trace
+    parser.add_argument('--profile')
+    parser.add_argument('--trace')
+    args = parser.parse_args()
+    if args.read_jobs > 1 and args.where != 'none':
+        parser.error('--read-jobs is not supported with --where')
+    main(args)
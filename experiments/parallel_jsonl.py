@@ -0,0 +1,107 @@
+import os
+import json
+import gzip
+import queue
+import collections
+import multiprocessing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(line):
+    """
+    json.loads, with orjson if it is installed. orjson rejects some inputs
+    that json accepts, such as lone surrogates, which fall back to json.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except ValueError:
+            pass
+    return json.loads(line)
+
+
+def _decode_lines(data):
+    return [json_loads(line) for line in data.split(b'\n') if line.strip()]
+
+
+def _decode_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return _decode_lines(f.read(end - start))
+
+
+def _byte_ranges(path, chunk_bytes):
+    """
+    Splits a file into ranges of about chunk_bytes that end at line ends.
+    """
+    size = os.path.getsize(path)
+    start = 0
+    with open(path, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+
+def _gz_chunks(path, chunk_bytes):
+    with gzip.open(path) as f:
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            yield b''.join(lines)
+
+
+def read_jsonl_parallel(path, jobs=4, ordered=True, chunk_bytes=2 ** 22,
+                        max_pending=None):
+    """
+    Reads a .jsonl or .jsonl.gz file like read_jsonl, but decodes chunks
+    of about chunk_bytes in a pool of `jobs` processes. Uncompressed files
+    are split into byte ranges that workers read themselves; .gz files are
+    decompressed here and the raw chunks are sent to the workers. At most
+    max_pending chunks (default: 2 * jobs) are in flight, which bounds
+    memory. Items are yielded in file order, or in the order in which
+    chunks finish if ordered is False.
+    """
+    if str(path).endswith('.gz'):
+        tasks = ((_decode_lines, (data,))
+                 for data in _gz_chunks(path, chunk_bytes))
+    else:
+        tasks = ((_decode_range, (path, start, end))
+                 for start, end in _byte_ranges(path, chunk_bytes))
+    if max_pending is None:
+        max_pending = 2 * jobs
+
+    with multiprocessing.Pool(processes=jobs) as pool:
+        if ordered:
+            pending = collections.deque()
+            for func, args in tasks:
+                pending.append(pool.apply_async(func, args))
+                if len(pending) >= max_pending:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+        else:
+            finished = queue.Queue()
+            n_pending = 0
+            for func, args in tasks:
+                pool.apply_async(func, args, callback=finished.put,
+                                 error_callback=finished.put)
+                n_pending += 1
+                if n_pending >= max_pending:
+                    yield from _get_finished(finished)
+                    n_pending -= 1
+            for _ in range(n_pending):
+                yield from _get_finished(finished)
+
+
+def _get_finished(finished):
+    items = finished.get()
+    if isinstance(items, BaseException):
+        raise items
+    return items
@@ -0,0 +1,182 @@
+import os
+import inspect
+import hashlib
+import nltk
+import numpy as np
+import sent_splitter
+from data import Sentence, Article, CompactCluster
+
+
+FORMAT_VERSION = 1
+N_COLUMNS = 4
+
+
+def settings_fingerprint():
+    """
+    Identifies the splitter and tokenizer settings that produced a cache
+    entry: the splitter code, the nltk version and the language and model
+    of punkt. Entries written under a different fingerprint are never
+    loaded.
+    """
+    splitter = sent_splitter.get_splitter()
+    h = hashlib.sha1()
+    h.update(str(FORMAT_VERSION).encode())
+    h.update(nltk.__version__.encode())
+    h.update(inspect.getsource(sent_splitter).encode())
+    h.update(splitter.language.encode())
+    with nltk.data.find(splitter.punkt_resource).open() as f:
+        h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def content_hash(articles):
+    h = hashlib.sha1()
+    for a in articles:
+        for field in (a['title'], a['text']):
+            field = field.encode('utf-8', 'surrogatepass')
+            h.update(str(len(field)).encode())
+            h.update(b':')
+            h.update(field)
+    return h.hexdigest()
+
+
+class PreprocessCache:
+    """
+    On-disk cache of clusters processed by Summarizer._preprocess.
+
+    Each entry consists of two files: a .txt file with all sentence texts
+    and tokens concatenated, and a .npy file of int64 with the layout [n_sents, n_strings, sentence table, string offsets]. Every
+    row of the sentence table holds (article index, position, is_title,
+    n_words) and is followed in the string list by the sentence text and
+    its n_words tokens. Entries are stored in a subdirectory of cache_dir
+    named after settings_fingerprint(). Once that subdirectory grows
+    beyond max_size bytes, its least recently used entries are removed;
+    subdirectories of other settings are never touched, since other runs
+    may still use them, and can be deleted by hand.
+    """
+    def __init__(self, cache_dir, max_size=2 ** 32, evict_every=100):
+        self.max_size = max_size
+        self.evict_every = evict_every
+        self.fingerprint = settings_fingerprint()
+        self.dir = os.path.join(cache_dir, self.fingerprint)
+        self.n_stored = 0
+        os.makedirs(self.dir, exist_ok=True)
+
+    def _paths(self, key):
+        base = os.path.join(self.dir, key)
+        return base + '.npy', base + '.txt'
+
+    def load(self, articles, compact=False):
+        arr_path, txt_path = self._paths(content_hash(articles))
+        try:
+            arr = np.load(arr_path)
+            with open(txt_path, encoding='utf-8', errors='surrogatepass',
+                  newline='') as f:
+                blob = f.read()
+            os.utime(arr_path)
+        except (FileNotFoundError, ValueError):
+            return None
+        n_sents, n_strings = int(arr[0]), int(arr[1])
+        table = arr[2:2 + n_sents * N_COLUMNS].reshape(
+            n_sents, N_COLUMNS).tolist()
+        offsets = arr[2 + n_sents * N_COLUMNS:].tolist()
+        assert len(offsets) == n_strings + 1
+
+        if compact:
+            return self._load_compact(table, offsets, blob)
+
+        titles = [None] * len(articles)
+        article_sents = [[] for _ in articles]
+        k = 0
+        for article_idx, position, is_title, n_words in table:
+            strings = [blob[offsets[j]:offsets[j + 1]]
+                       for j in range(k, k + n_words + 1)]
+            k += n_words + 1
+            sent = Sentence(
+                text=strings[0],
+                words=strings[1:],
+                position=position,
+                is_title=bool(is_title)
+            )
+            if is_title:
+                titles[article_idx] = sent
+            else:
+                article_sents[article_idx].append(sent)
+        return [Article(t, sents) for t, sents in zip(titles, article_sents)]
+
+    def _load_compact(self, table, offsets, blob):
+        if len(table) == 0:
+            return []
+        cluster = CompactCluster()
+        k = 0
+        for _, position, is_title, n_words in table:
+            strings = [blob[offsets[j]:offsets[j + 1]]
+                       for j in range(k, k + n_words + 1)]
+            k += n_words + 1
+            if is_title and len(cluster.texts) > 0:
+                cluster.article_offsets.append(len(cluster.texts))
+            cluster.add_sent(
+                strings[0], strings[1:], position, bool(is_title))
+        cluster.article_offsets.append(len(cluster.texts))
+        return cluster.finalize().articles()
+
+    def store(self, articles, processed_articles):
+        table = []
+        strings = []
+        for article_idx, a in enumerate(processed_articles):
+            for s in [a.title] + a.sents:
+                table.append(
+                    (article_idx, s.position, int(s.is_title), len(s.words)))
+                strings.append(s.text)
+                strings.extend(s.words)
+        offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in strings], out=offsets[1:])
+        arr = np.concatenate([
+            np.array([len(table), len(strings)], dtype=np.int64),
+            np.array(table, dtype=np.int64).reshape(-1),
+            offsets
+        ])
+
+        arr_path, txt_path = self._paths(content_hash(articles))
+        tmp_suffix = '.{}.tmp'.format(os.getpid())
+        with open(txt_path + tmp_suffix, 'w', encoding='utf-8',
+                  errors='surrogatepass', newline='') as f:
+            f.write(''.join(strings))
+        with open(arr_path + tmp_suffix, 'wb') as f:
+            np.save(f, arr)
+        os.replace(txt_path + tmp_suffix, txt_path)
+        os.replace(arr_path + tmp_suffix, arr_path)
+
+        self.n_stored += 1
+        if self.n_stored % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries of the current settings
+        until they fit into max_size.
+        """
+        entries = []
+        total_size = 0
+        for e in os.scandir(self.dir):
+            if not e.name.endswith('.npy'):
+                continue
+            try:
+                arr_stat = e.stat()
+                txt_size = os.path.getsize(e.path[:-4] + '.txt')
+            except FileNotFoundError:
+                continue
+            size = arr_stat.st_size + txt_size
+            entries.append((arr_stat.st_mtime, size, e.path))
+            total_size += size
+
+        entries.sort()
+        for _, size, arr_path in entries:
+            if total_size <= self.max_size:
+                break
+            for path in (arr_path, arr_path[:-4] + '.txt'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
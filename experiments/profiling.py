@@ -0,0 +1,109 @@
+import os
+import time
+import contextlib
+import collections
+import utils
+
+
+class Profiler:
+    """
+    Records the wall time of named stages, e.g. preprocessing, similarity
+    computation or selection, together with sizes such as the number of
+    sentences. Summarizers record into Summarizer.profiler if it is set;
+    otherwise their stages are no-ops.
+    Events are (name, start, duration, pid, info) tuples, with start as
+    a Unix timestamp so that events of several processes line up.
+    """
+    def __init__(self):
+        self.events = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        start = time.time()
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.events.append(
+                (name, start, time.perf_counter() - t1, os.getpid(), info))
+
+    def drain(self):
+        """
+        Returns and removes all events recorded so far, e.g. to send them
+        from a worker process to the main process.
+        """
+        events = self.events
+        self.events = []
+        return events
+
+    def extend(self, events):
+        self.events.extend(events)
+
+    def summary(self):
+        """
+        Call count and total, mean and max time in seconds of each stage.
+        """
+        durations = collections.defaultdict(list)
+        for name, _, duration, _, _ in self.events:
+            durations[name].append(duration)
+        summary = {}
+        for name, ds in durations.items():
+            summary[name] = {
+                'calls': len(ds),
+                'total': sum(ds),
+                'mean': sum(ds) / len(ds),
+                'max': max(ds),
+            }
+        return summary
+
+    def slowest(self, name='cluster', k=10):
+        """
+        The k longest events of a stage with their sizes, e.g. the slowest
+        clusters of a dataset run.
+        """
+        events = [e for e in self.events if e[0] == name]
+        events.sort(key=lambda e: e[2], reverse=True)
+        return [dict(e[4], seconds=e[2]) for e in events[:k]]
+
+    def print_summary(self):
+        summary = self.summary()
+        for name, s in sorted(summary.items(), key=lambda x: -x[1]['total']):
+            print(f"{name}: calls={s['calls']} total={s['total']:.3f}s "
+                  f"mean={s['mean']:.5f}s max={s['max']:.5f}s")
+
+    def to_json(self, path):
+        utils.write_json({
+            'summary': self.summary(),
+            'slowest_clusters': self.slowest(),
+            'events': [
+                {'name': name, 'start': start, 'seconds': duration,
+                 'pid': pid, 'info': info}
+                for name, start, duration, pid, info in self.events
+            ]
+        }, path)
+
+    def to_chrome_trace(self, path):
+        """
+        Writes the events in Chrome's trace event format, which can be
+        opened in chrome://tracing or Perfetto, with one row per process.
+        """
+        trace_events = [
+            {'name': name, 'ph': 'X', 'ts': start * 1e6,
+             'dur': duration * 1e6, 'pid': pid, 'tid': pid, 'args': info}
+            for name, start, duration, pid, info in self.events
+        ]
+        utils.write_json({'traceEvents': trace_events,
+                          'displayTimeUnit': 'ms'}, path)
+
+
+# shared no-op context manager for disabled profiling
+NULL_STAGE = contextlib.nullcontext()
+
+
+def stage(profiler, name, **info):
+    """
+    profiler.stage(name, **info), or a no-op if profiler is None.
+    """
+    if profiler is None:
+        return NULL_STAGE
+    return profiler.stage(name, **info)
@@ -0,0 +1,80 @@
+import collections
+import numpy as np
+from scipy import sparse
+from vocab import ngram_hashes
+
+
+class RedundancyIndex:
+    """
+    Answers whether a candidate sentence is redundant with a growing set of
+    selected sentences: it is if, for any selected sentence, the fraction
+    of the candidate's bigrams (counted with repetition) that also occur in
+    the selected sentence is >= max_redundancy.
+
+    Bigrams are int64 keys computed from the token ids of each sentence
+    (see vocab.ngram_hashes), and an inverted index maps each bigram to the
+    selected sentences containing it, so a query costs O(number of bigrams
+    of the candidate).
+    """
+    def __init__(self, sents):
+        self.sents = sents
+        self.sent_bigrams = [None] * len(sents)
+        self.postings = collections.defaultdict(list)
+        self.selected = []
+
+    def _bigram_keys(self, i):
+        keys = self.sent_bigrams[i]
+        if keys is None:
+            keys = ngram_hashes(self.sents[i].ids, 2)
+            self.sent_bigrams[i] = keys
+        return keys
+
+    def add(self, i):
+        for b in set(self._bigram_keys(i).tolist()):
+            self.postings[b].append(i)
+        self.selected.append(i)
+
+    def is_redundant(self, i, max_redundancy):
+        keys = self._bigram_keys(i).tolist()
+        l = len(keys)
+        n_matching = collections.Counter()
+        for b in keys:
+            for j in self.postings.get(b, ()):
+                n_matching[j] += 1
+        return any(n / l >= max_redundancy for n in n_matching.values())
+
+    def redundant_mask(self, candidates, max_redundancy):
+        """
+        Batch version of is_redundant: builds a sparse candidate x bigram
+        count matrix and a bigram x selected incidence matrix, whose product
+        holds all overlap counts.
+        """
+        candidates = list(candidates)
+        mask = np.zeros(len(candidates), dtype=bool)
+        if len(candidates) == 0 or len(self.selected) == 0:
+            return mask
+        cand_keys = [self._bigram_keys(i) for i in candidates]
+        sel_keys = [np.unique(self._bigram_keys(j)) for j in self.selected]
+        lens = np.array([len(k) for k in cand_keys])
+        sel_lens = np.array([len(k) for k in sel_keys])
+        # map bigram keys to consecutive columns
+        _, columns = np.unique(
+            np.concatenate(cand_keys + sel_keys + [np.zeros(0, np.int64)]),
+            return_inverse=True)
+        n_bigrams = columns.max() + 1 if len(columns) > 0 else 0
+        A = sparse.csr_matrix(
+            (np.ones(lens.sum()),
+             (np.repeat(np.arange(len(candidates)), lens),
+              columns[:lens.sum()])),
+            shape=(len(candidates), n_bigrams)
+        )
+        B = sparse.csc_matrix(
+            (np.ones(sel_lens.sum()),
+             (columns[lens.sum():],
+              np.repeat(np.arange(len(self.selected)), sel_lens))),
+            shape=(n_bigrams, len(self.selected))
+        )
+        overlaps = (A @ B).tocoo()
+        ratios = overlaps.data / lens[overlaps.row]
+        mask[overlaps.row[ratios >= max_redundancy]] = True
+        return mask
@@ -0,0 +1,177 @@
+import os
+import argparse
+import numpy as np
+import utils
+import rouge
+from evaluate import print_mean, ROUGE_TYPES
+from dataset import read_clusters
+
+
+def ngram_keys(ids, n, vocab_size):
+    """
+    Encodes the n-grams (n = 1 or 2) of a token id array as int64 keys.
+    N-grams containing unknown tokens (id -1) get key -1.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if n == 1:
+        return ids
+    keys = ids[:-1] * vocab_size + ids[1:]
+    keys[(ids[:-1] < 0) | (ids[1:] < 0)] = -1
+    return keys
+
+
+def build_reference_index(dataset_path, out_dir, lowercase=False):
+    """
+    Tokenizes all reference summaries of a split once and stores their
+    token ids and ROUGE-1/2 n-gram count tables as .npy files in out_dir.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    cluster_ids = []
+    vocab = {}
+    token_ids = []
+    for c in read_clusters(dataset_path):
+        ref = c['summary'].lower() if lowercase else c['summary']
+        ids = [vocab.setdefault(t, len(vocab)) for t in rouge.tokenize(ref)]
+        token_ids.append(np.array(ids, dtype=np.int32))
+        cluster_ids.append(c['id'])
+
+    arrays = {
+        'tokens': np.concatenate(token_ids + [np.zeros(0, dtype=np.int32)]),
+        'token_offsets': np.cumsum([0] + [len(x) for x in token_ids])
+    }
+    for n in (1, 2):
+        keys, counts = [], []
+        for ids in token_ids:
+            k, c = np.unique(ngram_keys(ids, n, len(vocab)),
+                             return_counts=True)
+            keys.append(k)
+            counts.append(c.astype(np.int32))
+        arrays[f'keys_{n}'] = np.concatenate(
+            keys + [np.zeros(0, dtype=np.int64)])
+        arrays[f'counts_{n}'] = np.concatenate(
+            counts + [np.zeros(0, dtype=np.int32)])
+        arrays[f'offsets_{n}'] = np.cumsum([0] + [len(x) for x in keys])
+    for name, arr in arrays.items():
+        np.save(os.path.join(out_dir, name + '.npy'), arr)
+
+    vocab_list = [None] * len(vocab)
+    for t, i in vocab.items():
+        vocab_list[i] = t
+    utils.write_json({
+        'cluster_ids': cluster_ids,
+        'vocab': vocab_list,
+        'lowercase': lowercase
+    }, os.path.join(out_dir, 'index.json'))
+
+
+class ReferenceIndex:
+    """
+    Memory-mapped reference side of ROUGE evaluation, built with
+    build_reference_index. Only predictions need to be tokenized when
+    scoring against it. Scores are the same as from rouge.score_pair.
+    """
+    def __init__(self, index_dir):
+        meta = utils.read_json(os.path.join(index_dir, 'index.json'))
+        self.cluster_ids = meta['cluster_ids']
+        self.lowercase = meta['lowercase']
+        self.vocab = dict((t, i) for i, t in enumerate(meta['vocab']))
+        self.id_to_position = dict(
+            (c, i) for i, c in enumerate(self.cluster_ids))
+        self.arrays = {}
+        for fn in os.listdir(index_dir):
+            if fn.endswith('.npy'):
+                self.arrays[fn[:-4]] = np.load(
+                    os.path.join(index_dir, fn), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.cluster_ids)
+
+    def _slice(self, name, offsets_name, i):
+        offsets = self.arrays[offsets_name]
+        return self.arrays[name][offsets[i]:offsets[i + 1]]
+
+    def ref_tokens(self, cluster_id):
+        i = self.id_to_position[cluster_id]
+        return self._slice('tokens', 'token_offsets', i)
+
+    def encode(self, text):
+        if self.lowercase:
+            text = text.lower()
+        return [self.vocab.get(t, -1) for t in rouge.tokenize(text)]
+
+    def score(self, cluster_id, hyp):
+        """
+        (rouge-1, rouge-2, rouge-l) RougeScore tuples of a prediction.
+        """
+        i = self.id_to_position[cluster_id]
+        hyp_ids = self.encode(hyp)
+        ref_ids = self._slice('tokens', 'token_offsets', i)
+        scores = []
+        for n in (1, 2):
+            ref_keys = self._slice(f'keys_{n}', f'offsets_{n}', i)
+            ref_counts = self._slice(f'counts_{n}', f'offsets_{n}', i)
+            hyp_keys, hyp_counts = np.unique(
+                ngram_keys(hyp_ids, n, len(self.vocab)), return_counts=True)
+            _, ref_idx, hyp_idx = np.intersect1d(
+                ref_keys, hyp_keys, assume_unique=True, return_indices=True)
+            # n-grams with unknown tokens (key -1) never match
+            valid = ref_keys[ref_idx] >= 0
+            match = int(np.minimum(
+                ref_counts[ref_idx][valid], hyp_counts[hyp_idx][valid]).sum())
+            scores.append(rouge.prf_score(
+                match, int(hyp_counts.sum()), int(ref_counts.sum())))
+        lcs = rouge.lcs_length(ref_ids.tolist(), hyp_ids)
+        scores.append(rouge.prf_score(lcs, len(hyp_ids), len(ref_ids)))
+        return tuple(scores)
+
+
+def evaluate_many(index, pred_paths):
+    """
+    Scores several prediction files against one reference index in a
+    single pass. Returns a results dict per file, as evaluate_from_path.
+    Every file must hold one prediction per cluster of the index, in the
+    order of the index.
+    """
+    all_results = []
+    for _ in pred_paths:
+        all_results.append(dict((t, {'p': [], 'r': [], 'f': []})
+                                for t in ROUGE_TYPES))
+    all_preds = []
+    for path in pred_paths:
+        preds = list(utils.read_jsonl(path))
+        assert len(preds) == len(index), \
+            f'{path}: {len(preds)} predictions for {len(index)} clusters'
+        assert [p['cluster_id'] for p in preds] == index.cluster_ids, \
+            f'{path}: cluster ids do not match the reference index'
+        all_preds.append(preds)
+    for preds in zip(*all_preds):
+        for pred, results in zip(preds, all_results):
+            scores = index.score(pred['cluster_id'], pred['summary'])
+            for rouge_type, s in zip(ROUGE_TYPES, scores):
+                results[rouge_type]['p'].append(s.precision)
+                results[rouge_type]['r'].append(s.recall)
+                results[rouge_type]['f'].append(s.fscore)
+    return all_results
+
+
+def main(args):
+    if args.mode == 'build':
+        build_reference_index(args.dataset, args.index, args.lowercase)
+    elif args.mode == 'evaluate':
+        index = ReferenceIndex(args.index)
+        all_results = evaluate_many(index, args.preds)
+        for path, results in zip(args.preds, all_results):
+            print(path)
+            print_mean(results, ROUGE_TYPES)
+    else:
+        raise ValueError('Unknown or unspecified --mode: ' + str(args.mode))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode')
+    parser.add_argument('--dataset')
+    parser.add_argument('--index', required=True)
+    parser.add_argument('--preds', nargs='+')
+    parser.add_argument('--lowercase', action='store_true')
+    main(parser.parse_args())
@@ -0,0 +1,159 @@
+import argparse
+import multiprocessing
+from collections import Counter, namedtuple
+import numpy as np
+import utils
+
+# ROUGE-1, ROUGE-2 and ROUGE-L meant to match newsroom's ROUGE. This has
+# not been verified yet: run this script on a prediction file to compare
+# both before relying on its scores.
+
+RougeScore = namedtuple('RougeScore', ['precision', 'recall', 'fscore'])
+
+_tokenizer = None
+
+
+def tokenize(text):
+    """
+    spaCy's rule-based English tokenizer, loaded once per process.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        from spacy.lang.en import English
+        _tokenizer = English().tokenizer
+    return [t.text for t in _tokenizer(text)]
+
+
+def ngram_counts(tokens, n):
+    if n == 1:
+        return Counter(tokens)
+    return Counter(zip(*[tokens[i:] for i in range(n)]))
+
+
+def prf_score(match, hyp_total, ref_total):
+    precision = match / hyp_total if hyp_total > 0 else 0.
+    recall = match / ref_total if ref_total > 0 else 0.
+    if precision + recall > 0:
+        fscore = 2 * precision * recall / (precision + recall)
+    else:
+        fscore = 0.
+    return RougeScore(precision, recall, fscore)
+
+
+def _count_matches(ref_counts, hyp_counts):
+    if len(ref_counts) > len(hyp_counts):
+        ref_counts, hyp_counts = hyp_counts, ref_counts
+    match = sum(min(c, hyp_counts[x]) for x, c in ref_counts.items()
+                if x in hyp_counts)
+    return match
+
+
+def rouge_n(ref_tokens, hyp_tokens, n=1):
+    ref_counts = ngram_counts(ref_tokens, n)
+    hyp_counts = ngram_counts(hyp_tokens, n)
+    match = _count_matches(ref_counts, hyp_counts)
+    return prf_score(
+        match, sum(hyp_counts.values()), sum(ref_counts.values()))
+
+
+def lcs_length(a, b):
+    """
+    Length of the longest common subsequence of two token sequences, with
+    the bit-parallel algorithm of Allison & Dix / Hyyrö: one bit per token
+    of a, so each token of b costs a few big-integer operations.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if len(b) == 0:
+        return 0
+    match_masks = {}
+    for i, x in enumerate(a):
+        match_masks[x] = match_masks.get(x, 0) | (1 << i)
+    all_ones = (1 << len(a)) - 1
+    v = all_ones
+    for x in b:
+        u = v & match_masks.get(x, 0)
+        v = ((v + u) | (v - u)) & all_ones
+    return len(a) - bin(v).count('1')
+
+
+def rouge_l(ref_tokens, hyp_tokens):
+    lcs = lcs_length(ref_tokens, hyp_tokens)
+    return prf_score(lcs, len(hyp_tokens), len(ref_tokens))
+
+
+def score_pair(ref, hyp, lowercase=False):
+    """
+    ROUGE-1, ROUGE-2 and ROUGE-L of a prediction, tokenizing each text
+    only once.
+    """
+    if lowercase:
+        ref = ref.lower()
+        hyp = hyp.lower()
+    ref_tokens = tokenize(ref)
+    hyp_tokens = tokenize(hyp)
+    return (
+        rouge_n(ref_tokens, hyp_tokens, 1),
+        rouge_n(ref_tokens, hyp_tokens, 2),
+        rouge_l(ref_tokens, hyp_tokens)
+    )
+
+
+def _score_pair_args(args):
+    return score_pair(*args)
+
+
+def score_pairs(refs, hyps, lowercase=False, jobs=1, chunksize=256):
+    """
+    Scores many (reference, prediction) pairs, in a pool of `jobs`
+    processes if jobs > 1. Returns a list of (rouge-1, rouge-2, rouge-l)
+    RougeScore tuples.
+    """
+    args = [(ref, hyp, lowercase) for ref, hyp in zip(refs, hyps)]
+    if jobs <= 1:
+        return [score_pair(*x) for x in args]
+    with multiprocessing.Pool(processes=jobs) as pool:
+        return pool.map(_score_pair_args, args, chunksize=chunksize)
+
+
+def check_parity(refs, hyps, lowercase=False):
+    """
+    Maximum absolute difference to newsroom's ROUGE for each score.
+    """
+    from newsroom.analyze.rouge import ROUGE_L, ROUGE_N
+    diffs = np.zeros((3, 3))
+    for ref, hyp in zip(refs, hyps):
+        if lowercase:
+            ref, hyp = ref.lower(), hyp.lower()
+        expected = [ROUGE_N(ref, hyp, n=1), ROUGE_N(ref, hyp, n=2),
+                    ROUGE_L(ref, hyp)]
+        for i, (x, y) in enumerate(zip(expected, score_pair(ref, hyp))):
+            d = np.abs(np.array([x.precision, x.recall, x.fscore]) -
+                       np.array(y))
+            diffs[i] = np.maximum(diffs[i], d)
+    return diffs
+
+
+def main(args):
+    dataset = utils.read_jsonl(args.dataset)
+    refs, hyps = [], []
+    for cluster, pred in zip(dataset, utils.read_jsonl(args.preds)):
+        assert pred['cluster_id'] == cluster['id']
+        refs.append(cluster['summary'])
+        hyps.append(pred['summary'])
+    diffs = check_parity(refs, hyps, args.lowercase)
+    for rouge_type, d in zip(['rouge-1', 'rouge-2', 'rouge-l'], diffs):
+        print(rouge_type, 'max abs diff p:', d[0], 'r:', d[1], 'f:', d[2])
+    if diffs.max() > args.tolerance:
+        raise SystemExit('scores differ from newsroom')
+    print(f'{len(refs)} pairs agree with newsroom within {args.tolerance}')
+
+
+if __name__ == '__main__':
+    # compares this ROUGE implementation with newsroom's on a prediction file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--preds', required=True)
+    parser.add_argument('--lowercase', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1e-6)
+    main(parser.parse_args())
@@ -1,18 +1,26 @@
 import re
-from nltk import sent_tokenize
+import multiprocessing
+import nltk
+from nltk.tokenize.destructive import NLTKWordTokenizer
+
+
+GLUED_SENTS_PATTERN = re.compile(r'\.([A-Z])')
 
 
 class SentenceSplitter:
     """
     NLTK sent_tokenize + some fixes for common errors in news articles.
+    The punkt model and word tokenizer are loaded once per instance; use
+    get_splitter() to share one instance per process.
     """
-    def unglue(self, x):
-        g = x.group(0)
-        fixed = '{} {}'.format(g[0], g[1])
-        return fixed
+    def __init__(self, language='english'):
+        self.language = language
+        self.punkt_resource = f'tokenizers/punkt/{language}.pickle'
+        self.punkt = nltk.data.load(self.punkt_resource)
+        self.word_tokenizer = NLTKWordTokenizer()
 
     def fix_glued_sents(self, text):
-        return re.sub(r'\.[A-Z]', self.unglue, text)
+        return GLUED_SENTS_PATTERN.sub(r'. \1', text)
 
     def fix_line_broken_sents(self, sents):
         new_sents = []
@@ -22,7 +30,53 @@ class SentenceSplitter:
 
     def split_sents(self, text):
         text = self.fix_glued_sents(text)
-        sents = sent_tokenize(text)
+        sents = self.punkt.tokenize(text)
         sents = self.fix_line_broken_sents(sents)
         sents = [s for s in sents if s != '']
         return sents
+
+    def word_tokenize(self, text):
+        """
+        Same output as nltk.word_tokenize(text).
+        """
+        tokenize = self.word_tokenizer.tokenize
+        return [tok for s in self.punkt.tokenize(text) for tok in tokenize(s)]
+
+    def process_article(self, article):
+        """
+        Returns the tokenized title, the body sentences and their tokens.
+        """
+        sents = self.split_sents(article['text'])
+        return (
+            self.word_tokenize(article['title']),
+            sents,
+            [self.word_tokenize(s) for s in sents]
+        )
+
+    def process_articles(self, articles, jobs=1, pool=None):
+        """
+        process_article for a whole cluster. Articles are processed by the
+        given multiprocessing pool, or with jobs > 1 by a pool of `jobs`
+        worker processes started for this call, which pays off only for
+        very large clusters.
+        """
+        if pool is not None:
+            return pool.map(_process_article, articles, chunksize=8)
+        if jobs > 1 and not multiprocessing.current_process().daemon:
+            with multiprocessing.Pool(processes=jobs) as pool:
+                return pool.map(_process_article, articles, chunksize=8)
+        return [self.process_article(a) for a in articles]
+
+
+_splitter = None
+
+
+def get_splitter():
+    global _splitter
+    if _splitter is None:
+        _splitter = SentenceSplitter()
+    return _splitter
+
+
+def _process_article(article):
+    return get_splitter().process_article(article)
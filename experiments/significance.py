@@ -0,0 +1,120 @@
+import argparse
+import numpy as np
+import utils
+from evaluate import load_scores
+
+
+def load_system_scores(path, metric):
+    """
+    Per-cluster scores of one system for a metric such as 'rouge-1-f',
+    from a score store (.npz, see evaluate.score_shard) or from the results
+    json written by evaluate.py. Returns (cluster ids or None, scores).
+    """
+    if str(path).endswith('.npz'):
+        store = load_scores(path)
+        return store['cluster_id'], store[metric]
+    results = utils.read_json(path)
+    rouge_type, m = metric.rsplit('-', 1)
+    return None, np.array(results[rouge_type][m], dtype=np.float64)
+
+
+def align_scores(baseline, systems):
+    """
+    Aligns per-cluster scores of several systems with the baseline by
+    cluster id (where available) and returns them as arrays of shape
+    (n_clusters,) and (n_systems, n_clusters).
+    """
+    base_ids, base_scores = baseline
+    rows = []
+    for ids, scores in systems:
+        if base_ids is None or ids is None:
+            assert len(scores) == len(base_scores)
+            rows.append(scores)
+        else:
+            position = dict((c, i) for i, c in enumerate(ids.tolist()))
+            rows.append(scores[[position[c] for c in base_ids.tolist()]])
+    return base_scores, np.vstack(rows)
+
+
+def _resample_counts(rng, n_resamples, n):
+    """
+    Matrix of shape (n_resamples, n) counting how often each cluster is
+    drawn in each bootstrap resample.
+    """
+    idx = rng.randint(0, n, size=(n_resamples, n))
+    idx += np.arange(n_resamples)[:, None] * n
+    counts = np.bincount(idx.ravel(), minlength=n_resamples * n)
+    return counts.reshape(n_resamples, n).astype(np.float64)
+
+
+def paired_bootstrap(baseline, systems, n_resamples=10000, seed=0,
+                     block_size=1000):
+    """
+    Paired bootstrap test of each system against the baseline. Each block
+    of resamples is a count matrix, so the mean differences of all
+    systems in all resamples are one matrix product. Returns the mean
+    differences, one-sided p-values (fraction of resamples in which the
+    system is not better) and 95% confidence intervals of the differences.
+    """
+    rng = np.random.RandomState(seed)
+    diffs = systems - baseline[None, :]
+    n = diffs.shape[1]
+    resampled = []
+    for k in range(0, n_resamples, block_size):
+        counts = _resample_counts(rng, min(block_size, n_resamples - k), n)
+        resampled.append(counts @ diffs.T / n)
+    resampled = np.vstack(resampled)
+    p_values = (resampled <= 0).mean(0)
+    lower, upper = np.percentile(resampled, [2.5, 97.5], axis=0)
+    return diffs.mean(1), p_values, np.stack([lower, upper], axis=1)
+
+
+def approximate_randomization(baseline, systems, n_resamples=10000, seed=0,
+                              block_size=1000):
+    """
+    Two-sided approximate randomization test of each system against the
+    baseline: the system and baseline scores of each cluster are swapped
+    at random, i.e. the signs of the per-cluster differences are flipped.
+    Returns p-values.
+    """
+    rng = np.random.RandomState(seed)
+    diffs = systems - baseline[None, :]
+    n = diffs.shape[1]
+    observed = np.abs(diffs.mean(1))
+    n_extreme = np.zeros(len(diffs))
+    for k in range(0, n_resamples, block_size):
+        size = min(block_size, n_resamples - k)
+        signs = rng.randint(0, 2, size=(size, n)) * 2. - 1.
+        stats = np.abs(signs @ diffs.T / n)
+        n_extreme += (stats >= observed[None, :] - 1e-12).sum(0)
+    return (n_extreme + 1) / (n_resamples + 1)
+
+
+def main(args):
+    baseline = load_system_scores(args.baseline, args.metric)
+    systems = [load_system_scores(path, args.metric) for path in args.systems]
+    base_scores, sys_scores = align_scores(baseline, systems)
+    mean_diffs, boot_p, intervals = paired_bootstrap(
+        base_scores, sys_scores, args.n_resamples, args.seed)
+    ar_p = approximate_randomization(
+        base_scores, sys_scores, args.n_resamples, args.seed)
+
+    print('baseline:', args.baseline, args.metric,
+          round(base_scores.mean(), 4))
+    for i, path in enumerate(args.systems):
+        print(path,
+              'mean:', round(sys_scores[i].mean(), 4),
+              'diff:', round(mean_diffs[i], 4),
+              '95% CI:', np.round(intervals[i], 4).tolist(),
+              'bootstrap p:', round(boot_p[i], 4),
+              'randomization p:', round(ar_p[i], 4))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--baseline', required=True)
+    parser.add_argument('--systems', nargs='+', required=True)
+    parser.add_argument('--metric', default='rouge-1-f')
+    parser.add_argument('--n-resamples', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
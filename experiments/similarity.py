@@ -0,0 +1,97 @@
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+# bytes per entry of a block while it is computed: the sparse product
+# (float32 value and up to int64 column index) and its dense float32 copy
+# are alive at the same time
+BYTES_PER_ENTRY = 4 + 8 + 4
+
+
+class BlockwiseSimilarity:
+    """
+    Memory-bounded replacement for cosine_similarity(X) on large clusters.
+    Similarities are computed for blocks of rows at a time in float32, with
+    the sparse product and the dense copy of each block taking at most
+    about memory_budget bytes, and only entries >= threshold and/or the
+    top_k largest entries of each row (including the sentence itself) are
+    kept, in a sparse matrix. Without threshold and top_k, all nonzero
+    similarities are kept: the budget then only bounds the blocks, and the
+    result can still hold n^2 entries.
+    """
+    def __init__(self, threshold=None, top_k=None, memory_budget=2 ** 28):
+        self.threshold = threshold
+        self.top_k = top_k
+        self.memory_budget = memory_budget
+
+    def block_size(self, n):
+        return max(1, int(self.memory_budget //
+                          (BYTES_PER_ENTRY * max(n, 1))))
+
+    def _truncate(self, block):
+        """
+        Row and column indices of the entries of a dense block to keep.
+        """
+        keep = block > 0
+        if self.threshold is not None:
+            keep &= block >= self.threshold
+        if self.top_k is not None and block.shape[1] > self.top_k:
+            kth = np.partition(block, -self.top_k, axis=1)[:, -self.top_k]
+            keep &= block >= kth[:, None]
+        return np.nonzero(keep)
+
+    def pairwise(self, X):
+        """
+        Returns the sparse float32 similarity matrix of the rows of X and,
+        as float64, the exact row sums of the full (untruncated) matrix,
+        which the submodular coverage function needs.
+        """
+        X = normalize(sparse.csr_matrix(X, dtype=np.float32))
+        n = X.shape[0]
+        XT = X.T.tocsc()
+        rows, cols, values = [], [], []
+        step = self.block_size(n)
+        for start in range(0, n, step):
+            block = (X[start:start + step] @ XT).toarray()
+            r, c = self._truncate(block)
+            rows.append(r + start)
+            cols.append(c)
+            values.append(block[r, c])
+        S = sparse.csr_matrix(
+            (np.concatenate(values + [np.zeros(0, dtype=np.float32)]),
+             (np.concatenate(rows + [np.zeros(0, dtype=np.int64)]),
+              np.concatenate(cols + [np.zeros(0, dtype=np.int64)]))),
+            shape=(n, n), dtype=np.float32
+        )
+        X64 = X.astype(np.float64)
+        sums = np.asarray(X64 @ X64.sum(0).T).ravel()
+        return S, sums
+
+    @staticmethod
+    def from_spec(spec):
+        """
+        Parses a command line string such as 'blockwise,top_k=50,budget=64'
+        (budget in MB).
+        """
+        _, *options = spec.split(',')
+        kwargs = {}
+        for option in options:
+            key, _, value = option.partition('=')
+            if key == 'threshold':
+                kwargs['threshold'] = float(value)
+            elif key == 'top_k':
+                kwargs['top_k'] = int(value)
+            elif key == 'budget':
+                kwargs['memory_budget'] = int(value) * 2 ** 20
+            else:
+                raise ValueError('Unknown similarity option: ' + key)
+        return BlockwiseSimilarity(**kwargs)
+
+
+def column(S, j):
+    """
+    Column j of a dense or sparse similarity matrix as a 1-d array.
+    """
+    if sparse.issparse(S):
+        return S[:, j].toarray().ravel()
+    return np.asarray(S[:, j]).ravel()
@@ -1,11 +1,124 @@
+import os
+import json
+import time
+import collections
+import multiprocessing
 import utils
-from nltk import word_tokenize, bigrams
-from sent_splitter import SentenceSplitter
-from data import Sentence, Article
+import vocab
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sent_splitter import get_splitter
+from data import Sentence, Article, CompactCluster
+from preprocess_cache import PreprocessCache
+from vocab import get_vocab, load_vocab
+from profiling import Profiler, stage
+from dedup import format_stats
+from dataset import read_clusters
+
+
+_worker_summarizer = None
+_worker_settings = None
+_worker_oracle = False
+
+
+def _init_worker(summarizer, summarize_settings, oracle, cache_dir=None,
+                 cache_size=None, compact=False, vocab_path=None,
+                 profile=False, deduplicator=None):
+    global _worker_summarizer, _worker_settings, _worker_oracle
+    _worker_summarizer = summarizer
+    _worker_settings = summarize_settings
+    _worker_oracle = oracle
+    if cache_dir is not None:
+        Summarizer.cache = PreprocessCache(cache_dir, max_size=cache_size)
+    Summarizer.compact = compact
+    if vocab_path is not None:
+        load_vocab(vocab_path)
+    Summarizer.profiler = Profiler() if profile else None
+    Summarizer.deduplicator = deduplicator
+
+
+def _save_worker_state():
+    """
+    The globals and Summarizer attributes that _init_worker sets, so that a
+    run in the main process can restore them with _restore_worker_state.
+    """
+    return (_worker_summarizer, _worker_settings, _worker_oracle,
+            Summarizer.cache, Summarizer.compact, Summarizer.profiler,
+            Summarizer.deduplicator, get_vocab())
+
+
+def _restore_worker_state(state):
+    global _worker_summarizer, _worker_settings, _worker_oracle
+    (_worker_summarizer, _worker_settings, _worker_oracle,
+     Summarizer.cache, Summarizer.compact, Summarizer.profiler,
+     Summarizer.deduplicator, vocab._vocab) = state
+
+
+def _summarize_cluster(cluster):
+    profiler = Summarizer.profiler
+    articles = cluster['articles']
+    info = {}
+    if profiler is not None:
+        info = {'cluster_id': cluster['id'], 'n_articles': len(articles),
+                'n_chars': sum(len(a['text']) for a in articles)}
+    with stage(profiler, 'cluster', **info):
+        if _worker_oracle:
+            summary = _worker_summarizer.summarize(
+                cluster['summary'], articles, **_worker_settings)
+        else:
+            summary = _worker_summarizer.summarize(
+                articles, **_worker_settings)
+    result = {'cluster_id': cluster['id'], 'summary': summary}
+    if profiler is not None:
+        # events of worker processes travel back with their results
+        result['profile'] = profiler.drain()
+    if Summarizer.deduplicator is not None:
+        result['dedup'] = Summarizer.deduplicator.drain_stats()
+    return result
+
+
+def _read_done_predictions(pred_path):
+    """
+    Returns the cluster ids already written to pred_path. A trailing line
+    that was only partially written when a run was killed is truncated.
+    """
+    done_ids = []
+    if not os.path.exists(pred_path):
+        return done_ids
+    valid_bytes = 0
+    with open(pred_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            done_ids.append(json.loads(line)['cluster_id'])
+            valid_bytes += len(line)
+    if valid_bytes < os.path.getsize(pred_path):
+        with open(pred_path, 'r+b') as f:
+            f.truncate(valid_bytes)
+    return done_ids
 
 
 class Summarizer:
 
+    # optional PreprocessCache shared by all summarizers and oracles
+    cache = None
+    # build array-backed CompactCluster views instead of Sentence objects
+    compact = False
+    # fitted tfidf.CorpusTfidf for global IDF, None for per-cluster IDF
+    tfidf = None
+    # worker processes used to split and tokenize the articles of a
+    # cluster, started anew for each cluster
+    preprocess_jobs = 1
+    # profiling.Profiler recording per-stage times, None to disable
+    profiler = None
+    # candidates.CandidatePruner applied before scoring, None to disable
+    pruner = None
+    # dedup.ArticleDeduplicator collapsing near-duplicate articles of a
+    # cluster after preprocessing, None to disable
+    deduplicator = None
+
+    def _stage(self, name, **info):
+        return stage(self.profiler, name, **info)
+
     def _deduplicate(self, sents):
         seen = set()
         uniq_sents = []
@@ -15,6 +128,13 @@ class Summarizer:
                 uniq_sents.append(s)
         return uniq_sents
 
+    def _prune(self, sents, out_titles, min_sent_tokens, max_sent_tokens):
+        if self.pruner is None:
+            return sents
+        with self._stage('prune', n_sents=len(sents)):
+            return self.pruner.prune(
+                sents, out_titles, min_sent_tokens, max_sent_tokens)
+
     def _sent_len(self, sent, len_type):
         if len_type == 'chars':
             return len(sent.text)
@@ -25,36 +145,56 @@ class Summarizer:
         else:
             raise ValueError('len_type must be in (chars|words|sents)')
 
-    def _is_redundant(self, sents, selected, new, max_redundancy):
-        new_bigrams = list(bigrams(sents[new].words))
-        l = len(new_bigrams)
-        for i in selected:
-            old_bigrams = list(bigrams(sents[i].words))
-            n_matching = len([x for x in new_bigrams if x in old_bigrams])
-            if n_matching == 0:
-                continue
-            else:
-                overlap = n_matching / l
-                if overlap >= max_redundancy:
-                    return True
-        return False
+    def _vectorize(self, sents):
+        with self._stage('vectorize', n_sents=len(sents)):
+            if self.tfidf is None:
+                vectorizer = TfidfVectorizer(
+                    lowercase=True, stop_words='english')
+                return vectorizer.fit_transform([s.text for s in sents])
+            return self.tfidf.transform_ids(
+                [s.ids for s in sents], get_vocab())
 
     def _preprocess(self, articles):
-        sent_splitter = SentenceSplitter()
+        with self._stage('preprocess', n_articles=len(articles)):
+            processed_articles = self._preprocess_articles(articles)
+        if self.deduplicator is None or len(processed_articles) < 2:
+            return processed_articles
+        with self._stage('dedup', n_articles=len(processed_articles)):
+            return self.deduplicator.deduplicate(processed_articles)
+
+    def _preprocess_articles(self, articles):
+        if self.cache is not None:
+            processed_articles = self.cache.load(articles, self.compact)
+            if processed_articles is not None:
+                return processed_articles
+
+        processed = get_splitter().process_articles(
+            articles, jobs=self.preprocess_jobs)
+        if self.compact:
+            cluster = CompactCluster()
+            for a, (title_words, body_sents, body_words) in zip(
+                    articles, processed):
+                cluster.add_article(
+                    a['title'], title_words, body_sents, body_words)
+            processed_articles = cluster.finalize().articles()
+            if self.cache is not None:
+                self.cache.store(articles, processed_articles)
+            return processed_articles
+
         processed_articles = []
-        for a in articles:
-            body_sents = sent_splitter.split_sents(a['text'])
+        for a, (title_words, body_sents, body_words) in zip(
+                articles, processed):
             processed_title = Sentence(
                 text=a['title'],
-                words=word_tokenize(a['title']),
+                words=title_words,
                 position=-1,
                 is_title=True
             )
             processed_sents = []
-            for position, s in enumerate(body_sents):
+            for position, (s, words) in enumerate(zip(body_sents, body_words)):
                 processed_sent = Sentence(
                     text=s,
-                    words=word_tokenize(s),
+                    words=words,
                     position=position
                 )
                 processed_sents.append(processed_sent)
@@ -62,6 +202,8 @@ class Summarizer:
             processed_article = Article(processed_title, processed_sents)
             processed_articles.append(processed_article)
 
+        if self.cache is not None:
+            self.cache.store(articles, processed_articles)
         return processed_articles
 
     def _preprocess_sents(self, raw_sents):
@@ -69,7 +211,7 @@ class Summarizer:
         for s in raw_sents:
             processed_sent = Sentence(
                 text=s,
-                words=word_tokenize(s),
+                words=get_splitter().word_tokenize(s),
                 position=None
             )
             processed_sents.append(processed_sent)
@@ -84,3 +226,118 @@ class Summarizer:
                   min_sent_tokens=60,
                   max_sent_tokens=7):
         raise NotImplementedError
+
+    @staticmethod
+    def summarize_dataset(summarizer,
+                          dataset_path,
+                          pred_path,
+                          summarize_settings,
+                          start=-1,
+                          stop=-1,
+                          batchsize=32,
+                          jobs=4,
+                          oracle=False,
+                          override=False,
+                          cache_dir=None,
+                          cache_size=2 ** 32,
+                          compact=False,
+                          vocab_path=None,
+                          profiler=None,
+                          deduplicator=None,
+                          query=None,
+                          read_jobs=1):
+        """
+        Streams clusters from dataset_path through a persistent pool of
+        `jobs` worker processes and writes predictions in dataset order to
+        pred_path, every `batchsize` clusters. Predictions already in
+        pred_path are kept and the run resumes after them, unless override
+        is set. If cache_dir is given, preprocessed clusters are cached
+        there and reused by later runs on the same split. If vocab_path is
+        given, token ids come from that saved vocab.Vocabulary. If a
+        profiling.Profiler is given, the stage events of all workers are
+        collected in it. If a dedup.ArticleDeduplicator is given,
+        near-duplicate articles are removed from each cluster and the
+        numbers of removed articles and sentences are printed at the end.
+        If a dataset.ClusterQuery is given, only matching clusters are
+        summarized, and start and stop count matching clusters. With
+        read_jobs > 1, the dataset is decoded in that many extra processes.
+        """
+        if override and os.path.exists(pred_path):
+            os.remove(pred_path)
+        done_ids = _read_done_predictions(pred_path)
+
+        start = max(start, 0)
+        stop = None if stop < 0 else stop
+        clusters = read_clusters(dataset_path, query, start, stop, read_jobs)
+
+        for done_id in done_ids:
+            cluster = next(clusters, None)
+            assert cluster is not None and cluster['id'] == done_id, \
+                'predictions do not match dataset, use override to restart'
+        n_done = len(done_ids)
+        if n_done > 0:
+            print(f'resuming after {n_done} clusters')
+
+        if jobs <= 1:
+            # _init_worker configures this process, which is undone at the
+            # end so that later runs start from the same state
+            saved_state = _save_worker_state()
+            _init_worker(summarizer, summarize_settings, oracle,
+                         cache_dir, cache_size, compact, vocab_path,
+                         profiler is not None, deduplicator)
+            results = map(_summarize_cluster, clusters)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(
+                processes=jobs,
+                initializer=_init_worker,
+                initargs=(summarizer, summarize_settings, oracle,
+                          cache_dir, cache_size, compact, vocab_path,
+                          profiler is not None, deduplicator)
+            )
+            results = Summarizer._ordered_results(
+                pool, clusters, max_pending=2 * max(batchsize, jobs))
+
+        batch = []
+        dedup_stats = collections.Counter()
+        t1 = time.time()
+        try:
+            for pred in results:
+                events = pred.pop('profile', None)
+                if events:
+                    profiler.extend(events)
+                dedup_stats.update(pred.pop('dedup', {}))
+                batch.append(pred)
+                if len(batch) >= batchsize:
+                    utils.write_jsonl(batch, pred_path, override=False)
+                    n_done += len(batch)
+                    batch = []
+                    t2 = time.time()
+                    print(f'{n_done} clusters done, last batch: '
+                          f'{round(t2 - t1, 2)} seconds')
+                    t1 = t2
+            if batch:
+                utils.write_jsonl(batch, pred_path, override=False)
+                n_done += len(batch)
+                print(f'{n_done} clusters done')
+            if deduplicator is not None:
+                print(format_stats(dedup_stats))
+        finally:
+            if pool is not None:
+                pool.terminate()
+            else:
+                _restore_worker_state(saved_state)
+
+    @staticmethod
+    def _ordered_results(pool, clusters, max_pending):
+        """
+        Submits clusters to the pool lazily, keeping at most max_pending in
+        flight, and yields their results in input order.
+        """
+        pending = collections.deque()
+        for cluster in clusters:
+            pending.append(pool.apply_async(_summarize_cluster, (cluster,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
@@ -0,0 +1,201 @@
+import re
+import zlib
+import argparse
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+from sklearn.preprocessing import normalize
+import utils
+from summarizer import Summarizer
+from preprocess_cache import PreprocessCache
+from dataset import read_clusters
+
+
+TOKEN_PATTERN = re.compile(r'(?u)\b\w\w+\b')
+
+
+class CorpusTfidf:
+    """
+    TF-IDF vectorizer whose IDF statistics are fitted once over a whole
+    corpus (e.g. the train split) instead of on each cluster. Works on
+    already tokenized sentences and mirrors the preprocessing of
+    TfidfVectorizer(lowercase=True, stop_words='english'): terms are the
+    lowercased \\w\\w+ parts of each token, minus English stop words, with
+    smoothed IDF and L2-normalized rows.
+
+    By default terms are mapped to a fixed vocabulary built during fitting.
+    If n_features is given, terms are hashed into n_features columns
+    instead, which needs no vocabulary and also covers unseen terms.
+    Sentences are the documents for document frequencies, as in the
+    per-cluster vectorizers of the summarizers.
+    """
+    def __init__(self, n_features=None, min_df=1):
+        self.n_features = n_features
+        self.min_df = min_df
+        self.n_docs = 0
+        self.vocab = None
+        self.idf = None
+        self._feature_cache = {}
+        self._id_table = None
+        if n_features is None:
+            self.df = {}
+        else:
+            self.df = np.zeros(n_features, dtype=np.int64)
+
+    def _word_terms(self, w):
+        return [t for t in TOKEN_PATTERN.findall(w.lower())
+                if t not in ENGLISH_STOP_WORDS]
+
+    def _terms(self, words):
+        return [t for w in words for t in self._word_terms(w)]
+
+    def _features(self, words):
+        """
+        Column indices of the terms in words, with results cached per word.
+        """
+        cache = self._feature_cache
+        features = []
+        for w in words:
+            f = cache.get(w)
+            if f is None:
+                terms = self._word_terms(w)
+                if self.n_features is None:
+                    f = [self.vocab[t] for t in terms if t in self.vocab]
+                else:
+                    f = [self._hash(t) for t in terms]
+                cache[w] = f
+            features.extend(f)
+        return features
+
+    def _hash(self, term):
+        return zlib.crc32(term.encode('utf-8')) % self.n_features
+
+    def partial_fit(self, sents_words):
+        for words in sents_words:
+            terms = set(self._terms(words))
+            if self.n_features is None:
+                for t in terms:
+                    self.df[t] = self.df.get(t, 0) + 1
+            else:
+                for j in set(self._hash(t) for t in terms):
+                    self.df[j] += 1
+            self.n_docs += 1
+        return self
+
+    def finalize(self):
+        """
+        Computes the vocabulary and IDF weights from the collected counts.
+        """
+        if self.n_features is None:
+            terms = sorted(t for t, df in self.df.items() if df >= self.min_df)
+            self.vocab = dict((t, j) for j, t in enumerate(terms))
+            df = np.array([self.df[t] for t in terms], dtype=np.float64)
+        else:
+            df = self.df.astype(np.float64)
+        self.idf = np.log((1 + self.n_docs) / (1 + df)) + 1
+        self._feature_cache = {}
+        self._id_table = None
+        return self
+
+    def fit(self, sents_words):
+        return self.partial_fit(sents_words).finalize()
+
+    def transform(self, sents_words):
+        indices = []
+        indptr = [0]
+        for words in sents_words:
+            indices.extend(self._features(words))
+            indptr.append(len(indices))
+        X = sparse.csr_matrix(
+            (np.ones(len(indices)), indices, indptr),
+            shape=(len(sents_words), len(self.idf))
+        )
+        X.sum_duplicates()
+        X = X @ sparse.diags(self.idf)
+        return normalize(X, norm='l2', copy=False)
+
+    def _id_features(self, vocab):
+        """
+        Column indices of the terms of every word in a vocab.Vocabulary,
+        as a CSR-like (offsets, columns) table indexed by token id. Only
+        words added to the vocabulary since the last call are processed.
+        """
+        if self._id_table is None or self._id_table[0] is not vocab:
+            self._id_table = (vocab, np.zeros(1, dtype=np.int64),
+                              np.zeros(0, dtype=np.int64))
+        _, offsets, columns = self._id_table
+        n_known = len(offsets) - 1
+        if n_known < len(vocab):
+            new = [self._features([w]) for w in vocab.words[n_known:]]
+            new_offsets = offsets[-1] + np.cumsum([len(f) for f in new])
+            offsets = np.concatenate([offsets, new_offsets])
+            columns = np.concatenate(
+                [columns, np.array([j for f in new for j in f],
+                                   dtype=np.int64)])
+            self._id_table = (vocab, offsets, columns)
+        return offsets, columns
+
+    def transform_ids(self, sents_ids, vocab):
+        """
+        Same as transform, for sentences given as token id arrays of a
+        vocab.Vocabulary. The term columns of all tokens are gathered with
+        array operations instead of per-word lookups.
+        """
+        offsets, columns = self._id_features(vocab)
+        lens = np.array([len(ids) for ids in sents_ids], dtype=np.int64)
+        ids = np.concatenate(
+            [np.asarray(x, dtype=np.int64) for x in sents_ids] +
+            [np.zeros(0, dtype=np.int64)])
+        starts = offsets[ids]
+        counts = offsets[ids + 1] - starts
+        n = counts.sum()
+        # position of each term column within its token's table row
+        within = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts)
+        indices = columns[np.repeat(starts, counts) + within]
+        token_sents = np.repeat(np.arange(len(sents_ids)), lens)
+        X = sparse.csr_matrix(
+            (np.ones(n), (np.repeat(token_sents, counts), indices)),
+            shape=(len(sents_ids), len(self.idf))
+        )
+        X = X @ sparse.diags(self.idf)
+        return normalize(X, norm='l2', copy=False)
+
+    def save(self, path):
+        state = dict((k, v) for k, v in self.__dict__.items()
+                     if k not in ('_feature_cache', '_id_table'))
+        utils.dump_pkl(state, path)
+
+    @staticmethod
+    def load(path):
+        tfidf = CorpusTfidf()
+        tfidf.__dict__.update(utils.load_pkl(path))
+        return tfidf
+
+
+def main(args):
+    clusters = read_clusters(args.dataset)
+    tfidf = CorpusTfidf(n_features=args.n_features, min_df=args.min_df)
+    if args.cache_dir is not None:
+        Summarizer.cache = PreprocessCache(args.cache_dir)
+    summarizer = Summarizer()
+    for i, c in enumerate(clusters):
+        if args.stop > -1 and i >= args.stop:
+            break
+        articles = summarizer._preprocess(c['articles'])
+        tfidf.partial_fit([s.words for a in articles for s in a.sents])
+        if i % 100 == 0:
+            print(i, 'clusters done')
+    tfidf.finalize()
+    print('sentences:', tfidf.n_docs, 'features:', len(tfidf.idf))
+    tfidf.save(args.o)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--o', required=True)
+    parser.add_argument('--n-features', type=int, default=None)
+    parser.add_argument('--min-df', type=int, default=1)
+    parser.add_argument('--stop', type=int, default=-1)
+    parser.add_argument('--cache-dir')
+    main(parser.parse_args())
@@ -1,6 +1,7 @@
 import json
 import gzip
 import pickle
+from parallel_jsonl import json_loads, read_jsonl_parallel
 
 
 def read_lines(path):
@@ -0,0 +1,156 @@
+import string
+import argparse
+import numpy as np
+from nltk import word_tokenize
+from spacy.lang.en import STOP_WORDS
+import utils
+from dataset import read_clusters
+STOP_WORDS |= set(string.punctuation)
+
+
+FNV_OFFSET = np.uint64(14695981039346656037)
+FNV_PRIME = np.uint64(1099511628211)
+
+
+class Vocabulary:
+    """
+    Interns tokens to int32 ids. One vocabulary is shared by all clusters
+    processed in a process (see get_vocab), so token and n-gram comparisons
+    within and across clusters are integer comparisons. Words are appended
+    as they are seen. A vocabulary saved once over a dataset and loaded
+    with load_vocab gives the same ids to the same words in every process
+    and every run.
+    """
+    def __init__(self, words=()):
+        self.words = []
+        self.word_to_id = {}
+        self._content_mask = np.zeros(0, dtype=bool)
+        self._n_masked = 0
+        for w in words:
+            self.add(w)
+
+    def __len__(self):
+        return len(self.words)
+
+    def add(self, w):
+        i = self.word_to_id.get(w)
+        if i is None:
+            i = len(self.words)
+            self.word_to_id[w] = i
+            self.words.append(w)
+        return i
+
+    def encode(self, words):
+        word_to_id = self.word_to_id
+        ids = np.empty(len(words), dtype=np.int32)
+        for k, w in enumerate(words):
+            i = word_to_id.get(w)
+            if i is None:
+                i = self.add(w)
+            ids[k] = i
+        return ids
+
+    def decode(self, ids):
+        words = self.words
+        return [words[i] for i in np.asarray(ids).tolist()]
+
+    def content_mask(self):
+        """
+        Boolean mask over all ids, True for words not in STOP_WORDS.
+        Extended to new words on each call, with the buffer doubling in
+        size so that growing it stays amortized O(1) per word.
+        """
+        n_known, n = self._n_masked, len(self.words)
+        if n_known < n:
+            if n > len(self._content_mask):
+                size = max(n, 2 * len(self._content_mask))
+                buf = np.zeros(size, dtype=bool)
+                buf[:n_known] = self._content_mask[:n_known]
+                self._content_mask = buf
+            self._content_mask[n_known:n] = [
+                w not in STOP_WORDS for w in self.words[n_known:]]
+            self._n_masked = n
+        return self._content_mask[:n]
+
+    def save(self, path):
+        utils.write_json(self.words, path)
+
+    @staticmethod
+    def load(path):
+        return Vocabulary(utils.read_json(path))
+
+
+def ngram_hashes(ids, n):
+    """
+    int64 keys of the n-grams of a token id array, in order. Unigrams and
+    bigrams are encoded exactly (a bigram is both int32 ids packed into
+    one int64), longer n-grams are FNV-1a hashes of their ids.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if n == 1:
+        return ids
+    if len(ids) < n:
+        return np.zeros(0, dtype=np.int64)
+    if n == 2:
+        return (ids[:-1] << 32) | ids[1:]
+    m = len(ids) - n + 1
+    keys = np.full(m, FNV_OFFSET, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for k in range(n):
+            keys = (keys ^ ids[k:k + m].astype(np.uint64)) * FNV_PRIME
+    return keys.view(np.int64)
+
+
+_vocab = None
+
+
+def get_vocab():
+    global _vocab
+    if _vocab is None:
+        _vocab = Vocabulary()
+    return _vocab
+
+
+def load_vocab(path):
+    """
+    Replaces the vocabulary of this process with a saved one.
+    """
+    global _vocab
+    _vocab = Vocabulary.load(path)
+    return _vocab
+
+
+def main(args):
+    from summarizer import Summarizer
+    from preprocess_cache import PreprocessCache
+    # run as a script, this module is __main__, while preprocessing interns
+    # tokens into the vocabulary of the imported vocab module
+    import vocab as vocab_module
+    clusters = read_clusters(args.dataset)
+    if args.cache_dir is not None:
+        Summarizer.cache = PreprocessCache(args.cache_dir)
+    summarizer = Summarizer()
+    vocab = vocab_module.get_vocab()
+    for i, c in enumerate(clusters):
+        if args.stop > -1 and i >= args.stop:
+            break
+        # preprocessing interns all article tokens
+        articles = summarizer._preprocess(c['articles'])
+        vocab.encode(word_tokenize(c['summary']))
+        missing = [w for a in articles for w in a.words()
+                   if w not in vocab.word_to_id]
+        assert not missing, f'article tokens not in vocabulary: {missing[:10]}'
+        if i % 100 == 0:
+            print(i, 'clusters done')
+    print('vocabulary size:', len(vocab))
+    vocab.save(args.o)
+    assert Vocabulary.load(args.o).words == vocab.words
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--o', required=True)
+    parser.add_argument('--stop', type=int, default=-1)
+    parser.add_argument('--cache-dir')
+    main(parser.parse_args())